@@ -0,0 +1,91 @@
+import random
+from collections import Counter
+
+from color import Color
+from match_with_video import MatchWithVideo
+from sampling import FrameReader, read_frames
+
+# Checks sample_colors_adaptive against sample_colors on scripted sequences of
+# board states, with no video involved. Every state lasts at least max_stride
+# samples, which is what the adaptive sampler needs to see all of them, and
+# some samples are occluded. Raises if the samples differ or if any sample is
+# decoded more than once.
+
+NUM_SEQUENCES = 200
+MAX_STRIDES = [2, 3, 4, 8, 16]
+
+
+# "decodes" sample i of a script to i, counting how often each one was read
+class ScriptedReader(FrameReader):
+    def __init__(self, num_samples: int):
+        super().__init__(None, 1.0)
+        self.num_samples = num_samples
+        self.reads: Counter[int] = Counter()
+
+    def read_frame(self, frame_index: int) -> int | None:
+        if frame_index >= self.num_samples:
+            return None
+        self.reads[frame_index] += 1
+        self.frames_decoded += 1
+        return frame_index
+
+
+def get_script(rng: random.Random, min_run: int) -> list[list[Color] | None]:
+    board = [Color.BLACK] * 25
+    script: list[list[Color] | None] = []
+    for _ in range(rng.randint(1, 12)):
+        square_index = rng.randrange(25)
+        board = board.copy()
+        board[square_index] = rng.choice(
+            [
+                c
+                for c in [Color.BLACK, Color.RED, Color.BLUE]
+                if c != board[square_index]
+            ]
+        )
+        script += [board] * rng.randint(min_run, 4 * min_run)
+    # occlusions, but never the first sample of a run so every state is seen
+    for index in range(1, len(script)):
+        if script[index] == script[index - 1] and rng.random() < 0.1:
+            script[index] = None
+    return script
+
+
+def get_samples(script: list[list[Color] | None], max_stride: int | None):
+    with_video = MatchWithVideo.__new__(MatchWithVideo)
+    with_video.get_colors = lambda frame, color_mask, time: script[frame]
+    reader = ScriptedReader(len(script))
+    times = [float(index) for index in range(len(script))]
+    if max_stride is None:
+        samples, _ = with_video.sample_colors(read_frames(reader, times), None)
+    else:
+        samples, _ = with_video.sample_colors_adaptive(reader, times, None, max_stride)
+    return samples, reader
+
+
+rng = random.Random(0)
+for max_stride in MAX_STRIDES:
+    decoded = 0
+    total = 0
+    for sequence in range(NUM_SEQUENCES):
+        script = get_script(rng, max_stride)
+        expected, _ = get_samples(script, None)
+        samples, reader = get_samples(script, max_stride)
+        if samples != expected:
+            raise Exception(
+                f"max_stride {max_stride}, sequence {sequence}: got samples at "
+                f"{[time for time, _ in samples]}, expected "
+                f"{[time for time, _ in expected]}"
+            )
+        index, reads = reader.reads.most_common(1)[0]
+        if reads > 1:
+            raise Exception(
+                f"max_stride {max_stride}, sequence {sequence}: sample {index} "
+                f"was decoded {reads} times"
+            )
+        decoded += reader.frames_decoded
+        total += len(script)
+    print(
+        f"max_stride {max_stride}: {NUM_SEQUENCES} sequences match, decoded "
+        f"{decoded} of {total} samples"
+    )
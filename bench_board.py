@@ -0,0 +1,149 @@
+import glob
+import os
+import random
+import timeit
+from collections import Counter
+
+from board import Board
+from changelog import Change, deserialize_changelog_file
+from color import Color
+from match import GoalCompletion, Match
+
+# Checks the Board based final stats against the list based version they
+# replaced on every output/*/changelog.txt, and times both. States and
+# changelogs stay lists, since a Board per sample made them about 3x slower,
+# so Match's versions are checked and timed against a copy of the originals to
+# keep it that way. They run on samples rebuilt from each changelog, with some
+# frames of random colors mixed in like a stream overlay would cause.
+
+BINGO_LINES = [
+    [0, 1, 2, 3, 4],
+    [5, 6, 7, 8, 9],
+    [10, 11, 12, 13, 14],
+    [15, 16, 17, 18, 19],
+    [20, 21, 22, 23, 24],
+    [0, 5, 10, 15, 20],
+    [1, 6, 11, 16, 21],
+    [2, 7, 12, 17, 22],
+    [3, 8, 13, 18, 23],
+    [4, 9, 14, 19, 24],
+    [0, 6, 12, 18, 24],
+    [4, 8, 12, 16, 20],
+]
+
+
+def get_bingo_and_scores_list(
+    changelog: list[Change],
+) -> tuple[int | None, list[tuple[Color, int]]]:
+    final_board = [Color.BLACK for _ in range(0, 25)]
+    for c in changelog:
+        final_board[c.square_index] = c.color
+    bingo_first_square = next(
+        (
+            line[0]
+            for line in BINGO_LINES
+            if final_board[line[0]] != Color.BLACK
+            and all(final_board[i] == final_board[line[0]] for i in line)
+        ),
+        None,
+    )
+    square_count = Counter(c for c in final_board if c != Color.BLACK)
+    return bingo_first_square, square_count.most_common()
+
+
+def get_bingo_and_scores_board(
+    changelog: list[Change],
+) -> tuple[int | None, list[tuple[Color, int]]]:
+    final_board = GoalCompletion.get_final_board_from_changelog(changelog)
+    return final_board.get_bingo_first_square(), final_board.get_scores()
+
+
+def get_changelog_list(samples: list[tuple[float, list[Color]]]) -> list[Change]:
+    states: list[tuple[float, list[Color]]] = []
+    recent_colors = None
+    for time, colors in samples:
+        if recent_colors != colors:
+            num_changes = 0
+            if recent_colors is not None:
+                num_changes = sum(
+                    1 for idx in range(0, 25) if recent_colors[idx] != colors[idx]
+                )
+            if num_changes < 5:
+                states.append((time, colors))
+                recent_colors = colors
+    changelog: list[Change] = []
+    for i in range(1, len(states)):
+        old_colors = states[i - 1][1]
+        new_colors = states[i][1]
+        for j in range(0, 25):
+            if old_colors[j] != new_colors[j]:
+                changelog.append(
+                    Change(time=states[i][0], square_index=j, color=new_colors[j])
+                )
+    return changelog
+
+
+def get_changelog_match(samples: list[tuple[float, list[Color]]]) -> list[Change]:
+    return Match.get_changelog_from_states(Match.get_states_from_samples(samples))
+
+
+def get_samples(
+    changelog: list[Change], rng: random.Random
+) -> list[tuple[float, list[Color]]]:
+    colors = [Color.BLACK] * 25
+    samples: list[tuple[float, list[Color]]] = []
+    for change in changelog:
+        colors = list(colors)
+        colors[change.square_index] = change.color
+        samples.append((change.time, colors))
+        if rng.random() < 0.2:
+            noisy = list(colors)
+            for i in rng.sample(range(25), rng.randint(1, 8)):
+                noisy[i] = rng.choice(list(Color))
+            samples.append((change.time + 0.5, noisy))
+    return samples
+
+
+def describe(changelog: list[Change]) -> list[tuple[float, int, Color]]:
+    return [(c.time, c.square_index, c.color) for c in changelog]
+
+
+rng = random.Random(0)
+changelogs: list[list[Change]] = []
+all_samples: list[list[tuple[float, list[Color]]]] = []
+for path in sorted(glob.glob(os.path.join("output", "*", "changelog.txt"))):
+    changelog = deserialize_changelog_file(path)
+    samples = get_samples(changelog, rng)
+    if get_bingo_and_scores_list(changelog) != get_bingo_and_scores_board(changelog):
+        raise Exception(f"Final stats differ for {path}")
+    if describe(get_changelog_list(samples)) != describe(get_changelog_match(samples)):
+        raise Exception(f"Changelogs differ for {path}")
+    changelogs.append(changelog)
+    all_samples.append(samples)
+
+for name, get_stats, get_changelog in [
+    ("list", get_bingo_and_scores_list, get_changelog_list),
+    ("board", get_bingo_and_scores_board, get_changelog_match),
+]:
+    stats_secs = min(
+        timeit.repeat(lambda: [get_stats(c) for c in changelogs], number=1, repeat=5)
+    )
+    changelog_secs = min(
+        timeit.repeat(
+            lambda: [get_changelog(s) for s in all_samples], number=1, repeat=5
+        )
+    )
+    print(
+        f"{name}: {len(changelogs)} changelogs, final stats "
+        f"{1000 * stats_secs:.1f} ms, states and changelog "
+        f"{1000 * changelog_secs:.1f} ms"
+    )
+
+colors = all_samples[0][-1][1]
+board = Board.from_colors(colors)
+from_colors_secs = min(timeit.repeat(lambda: Board.from_colors(colors), number=10000))
+bingo_secs = min(timeit.repeat(board.get_bingo_first_square, number=10000))
+print(
+    f"per board: from_colors {100 * from_colors_secs:.2f} us, "
+    f"get_bingo_first_square {100 * bingo_secs:.2f} us"
+)
@@ -0,0 +1,101 @@
+import cv2
+import os
+import random
+import timeit
+import numpy
+
+from color import Color
+from square import deserialize_board_file
+from video import (
+    CellMeanExtractor,
+    get_closest_color_name,
+    get_raw_colors,
+    get_reference_colors,
+    get_reference_palette,
+)
+
+# compares the per-cell python classifier against ReferencePalette on random
+# cell means, checking that both give the same colors
+
+NUM_FRAMES = 2000
+
+reference_colors = get_reference_colors()
+reference_palette = get_reference_palette()
+
+random.seed(0)
+frames = [
+    [[random.uniform(0, 255) for _ in range(3)] for _ in range(25)]
+    for _ in range(NUM_FRAMES)
+]
+# also include the swatches themselves and points halfway between them, where
+# ties are most likely
+swatches = [bgr[:3] for bgrs in reference_colors.values() for bgr in bgrs]
+midpoints = [[(a[k] + b[k]) / 2 for k in range(3)] for a in swatches for b in swatches]
+for i in range(0, len(swatches + midpoints), 25):
+    cells = (swatches + midpoints)[i : i + 25]
+    if len(cells) == 25:
+        frames.append(cells)
+arrays = [numpy.array(cells) for cells in frames]
+
+restriction_sets: list[None | set[Color]] = [
+    None,
+    {Color.BLACK, Color.RED, Color.BLUE},
+    {Color.BLACK, Color.TEAL, Color.NAVY},
+]
+for color_restrictions in restriction_sets:
+    valid_colors = (
+        reference_colors
+        if color_restrictions is None
+        else {
+            color: avgs
+            for color, avgs in reference_colors.items()
+            if color in color_restrictions
+        }
+    )
+    mask = reference_palette.get_mask(color_restrictions)
+
+    def run_loop() -> list[list[Color]]:
+        return [
+            [get_closest_color_name(valid_colors, cell) for cell in cells]
+            for cells in frames
+        ]
+
+    def run_vectorized() -> list[list[Color]]:
+        return [reference_palette.classify(cells, mask) for cells in arrays]
+
+    if run_loop() != run_vectorized():
+        raise Exception(f"Results differ for restrictions {color_restrictions}")
+
+    loop_secs = min(timeit.repeat(run_loop, number=1, repeat=5))
+    vectorized_secs = min(timeit.repeat(run_vectorized, number=1, repeat=5))
+    print(f"restrictions: {color_restrictions}")
+    print(f"  loop:       {1e6 * loop_secs / len(frames):.1f} us/frame")
+    print(f"  vectorized: {1e6 * vectorized_secs / len(frames):.1f} us/frame")
+    print(f"  speedup:    {loop_secs / vectorized_secs:.1f}x")
+
+# cell mean extraction on the saved frames, checking CellMeanExtractor against
+# get_raw_colors
+NUM_MATCHES = 10
+
+match_dirs = sorted(os.listdir("output"))[:NUM_MATCHES]
+reference_secs = 0.0
+extractor_secs = 0.0
+for match_dir in match_dirs:
+    frame = cv2.imread(os.path.join("output", match_dir, "frame.png"))
+    table = deserialize_board_file(os.path.join("output", match_dir, "table.json"))
+    extractor = CellMeanExtractor(table)
+
+    def run_reference() -> numpy.ndarray:
+        return numpy.array(get_raw_colors(table, frame))[:, :3]
+
+    def run_extractor() -> numpy.ndarray:
+        return extractor.get_means(frame)
+
+    if not numpy.array_equal(run_reference(), run_extractor()):
+        raise Exception(f"Cell means differ for {match_dir}")
+    reference_secs += min(timeit.repeat(run_reference, number=100, repeat=3)) / 100
+    extractor_secs += min(timeit.repeat(run_extractor, number=100, repeat=3)) / 100
+
+print(f"cell means over {len(match_dirs)} saved frames")
+print(f"  get_raw_colors:    {1e6 * reference_secs / len(match_dirs):.1f} us/frame")
+print(f"  CellMeanExtractor: {1e6 * extractor_secs / len(match_dirs):.1f} us/frame")
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+
+# Checks that the corrections journal survives a crash at any point, in a temp
+# dir so corrections.json and corrections.jsonl here aren't touched. A crash
+# is simulated by writing what it would leave on disk and loading the
+# corrections again like a new process would. Raises on the first case where
+# the loaded corrections aren't what was added before the crash.
+
+start_dir = os.getcwd()
+work_dir = tempfile.mkdtemp()
+shutil.copy("all_goals.txt", work_dir)
+os.chdir(work_dir)
+
+# text_correction loads the corrections from the working directory on import
+import text_correction
+from text_correction import (
+    CORRECTIONS_JOURNAL,
+    CORRECTIONS_SNAPSHOT,
+    add_correction,
+    compact_corrections,
+    load_corrections,
+)
+
+
+# what a new process would see
+def restart():
+    text_correction.corrections, text_correction.journal_length = load_corrections()
+
+
+def check(case: str, expected: dict[str, str]):
+    restart()
+    if text_correction.corrections != expected:
+        raise Exception(
+            f"{case}: loaded {text_correction.corrections}, expected {expected}"
+        )
+    for bad_text, good_text in expected.items():
+        if text_correction.get_confirmed_text(bad_text) != good_text:
+            raise Exception(f"{case}: {bad_text!r} isn't corrected to {good_text!r}")
+    print(f"{case}: ok")
+
+
+def reset():
+    for fname in [CORRECTIONS_SNAPSHOT, CORRECTIONS_JOURNAL]:
+        if os.path.isfile(fname):
+            os.remove(fname)
+    restart()
+
+
+try:
+    # a crash in the middle of an append leaves part of the last line
+    reset()
+    add_correction("Bad one", "Good one")
+    add_correction("Bad two", "Good two")
+    add_correction("Bad one", "Better one")
+    with open(CORRECTIONS_JOURNAL, "ab") as f:
+        f.write(json.dumps(["Bad three", "Good three"]).encode()[:15])
+    expected = {"Bad one": "Better one", "Bad two": "Good two"}
+    check("Torn last line", expected)
+
+    # the next append replaces the partial line instead of continuing it
+    add_correction("Bad four", "Good four")
+    expected["Bad four"] = "Good four"
+    check("Append after a torn line", expected)
+    with open(CORRECTIONS_JOURNAL, "rb") as f:
+        for line in f.read().splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                raise Exception(f"Journal has a partial line {line!r}")
+            json.loads(line)
+
+    # a crash after the new snapshot is swapped in but before the journal is
+    # removed leaves a journal that repeats the snapshot
+    remove = os.remove
+
+    def crash(path):
+        raise KeyboardInterrupt()
+
+    os.remove = crash
+    try:
+        compact_corrections()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove = remove
+    if not os.path.isfile(CORRECTIONS_JOURNAL):
+        raise Exception("The journal should have been left over")
+    check("Journal left over after compaction", expected)
+    add_correction("Bad two", "Better two")
+    expected["Bad two"] = "Better two"
+    check("Append to a left over journal", expected)
+    compact_corrections()
+    if os.path.isfile(CORRECTIONS_JOURNAL):
+        raise Exception("Compaction didn't remove the journal")
+    check("Compaction after a left over journal", expected)
+
+    # a crash while writing the new snapshot leaves a partial temp file next
+    # to the old snapshot, which is never read and is overwritten next time
+    add_correction("Bad five", "Good five")
+    with open(CORRECTIONS_SNAPSHOT + ".tmp", "w") as f:
+        f.write(json.dumps({**expected, "Bad five": "Good five"}, indent=2)[:40])
+    expected["Bad five"] = "Good five"
+    check("Half written snapshot", expected)
+    compact_corrections()
+    if os.path.isfile(CORRECTIONS_SNAPSHOT + ".tmp"):
+        raise Exception("Compaction left the temp snapshot behind")
+    check("Compaction after a half written snapshot", expected)
+finally:
+    os.chdir(start_dir)
+    shutil.rmtree(work_dir)
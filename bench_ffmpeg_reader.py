@@ -0,0 +1,149 @@
+import argparse
+import os
+import subprocess
+import tempfile
+import timeit
+import cv2
+import numpy
+
+from benchmark import SyntheticMatch
+from color import Color
+from sampling import FfmpegFrameReader, SeekingFrameReader, get_sample_times
+from square import Square, deserialize_board_file
+from video import CellMeanExtractor, get_reference_palette
+
+# Checks FfmpegFrameReader against seeking with cv2.VideoCapture: every sample
+# has to land on the same frame and get the same colors, and the cell means
+# from the cropped and scaled frames have to be close to the ones from full
+# frames. At scale 1 they should be identical. Raises if the colors differ.
+#
+# Runs on a match's video when given output/<id>. Without one it renders a
+# synthetic match like benchmark.py, plus a copy whose timestamps start at
+# START_OFFSET instead of 0, and also checks the colors against the script.
+
+# where the timestamps of the shifted copy of the synthetic match start
+START_OFFSET = 2.5
+
+palette = get_reference_palette()
+color_mask = palette.get_mask(None)
+
+
+# the colors on the synthetic board at frame_index
+def get_script_colors(synthetic: SyntheticMatch, frame_index: int) -> list[Color]:
+    colors = [Color.BLACK] * 25
+    for change in synthetic.changelog:
+        if round(change.time * synthetic.fps) <= frame_index:
+            colors[change.square_index] = change.color
+    return colors
+
+
+def check_video(
+    video_filename: str,
+    table: list[Square],
+    start: float,
+    scales: list[float],
+    synthetic: SyntheticMatch | None = None,
+):
+    print(video_filename)
+    extractor = CellMeanExtractor(table)
+    bounds = (extractor.x_min, extractor.x_max, extractor.y_min, extractor.y_max)
+    cap = cv2.VideoCapture(video_filename)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    times = get_sample_times(start, cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps, 5)
+
+    seek_reader = SeekingFrameReader(cap, fps)
+    reference_means: list[numpy.ndarray] = []
+
+    def run_seek():
+        reference_means.clear()
+        for time in times:
+            frame = seek_reader.read_at(time)
+            if frame is not None:
+                reference_means.append(extractor.get_means(frame))
+
+    seek_secs = timeit.timeit(run_seek, number=1)
+    print(f"seek: {len(times)} samples in {seek_secs:.1f}s")
+    reference_colors = [palette.classify(m, color_mask) for m in reference_means]
+    if synthetic is not None:
+        for time, colors in zip(times, reference_colors):
+            frame_index = seek_reader.get_frame_index(time)
+            if colors != get_script_colors(synthetic, frame_index):
+                raise Exception(f"Seeking got the wrong colors at {time}")
+
+    for scale in scales:
+        reader = FfmpegFrameReader(cap, fps, video_filename, times, 5, bounds, scale)
+        scaled_extractor = CellMeanExtractor(reader.map_table(table))
+        for time in times:
+            if reader.get_frame_index(time) != seek_reader.get_frame_index(time):
+                raise Exception(f"Sample at {time} is on a different frame")
+        means: list[numpy.ndarray] = []
+
+        def run_ffmpeg():
+            for time in times:
+                frame = reader.read_at(time)
+                if frame is not None:
+                    means.append(scaled_extractor.get_means(frame))
+
+        ffmpeg_secs = timeit.timeit(run_ffmpeg, number=1)
+        reader.close()
+        if len(means) != len(reference_means):
+            raise Exception(f"Got {len(means)} frames, expected {len(reference_means)}")
+        for time, frame_means, colors in zip(times, means, reference_colors):
+            if palette.classify(frame_means, color_mask) != colors:
+                raise Exception(f"Colors differ at {time} with scale {scale}")
+        max_diff = max(numpy.abs(a - b).max() for a, b in zip(means, reference_means))
+        print(
+            f"ffmpeg scale {scale}: {reader.width}x{reader.height} frames in "
+            f"{ffmpeg_secs:.1f}s, same colors, max cell mean difference "
+            f"{max_diff:.2f}"
+        )
+    cap.release()
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("dir", nargs="?", help="output/<id> with a video and table.json")
+parser.add_argument("--start", type=float, default=0)
+parser.add_argument("--scales", type=float, nargs="+", default=[1.0, 0.5])
+args = parser.parse_args()
+
+if args.dir is not None:
+    video_filename = next(
+        os.path.join(args.dir, fname)
+        for fname in os.listdir(args.dir)
+        if fname.startswith("video") and fname.count(".") == 1
+    )
+    table = deserialize_board_file(os.path.join(args.dir, "table.json"))
+    check_video(video_filename, table, args.start, args.scales)
+else:
+    synthetic = SyntheticMatch(
+        argparse.Namespace(
+            width=960,
+            height=540,
+            fps=30,
+            secs=120,
+            noise=False,
+            seed=0,
+            change_secs=10,
+        )
+    )
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_filename = os.path.join(work_dir, "video.mp4")
+        synthetic.render(video_filename, "mp4v", 0)
+        shifted_filename = os.path.join(work_dir, "shifted.mp4")
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-i",
+                video_filename,
+                "-c",
+                "copy",
+                "-output_ts_offset",
+                repr(START_OFFSET),
+                shifted_filename,
+            ],
+            check=True,
+        )
+        for fname in [video_filename, shifted_filename]:
+            check_video(fname, synthetic.table, args.start, args.scales, synthetic)
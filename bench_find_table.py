@@ -0,0 +1,171 @@
+import argparse
+import random
+import timeit
+from typing import Any
+
+from find_table import (
+    Cell,
+    find_table,
+    get_ocr_crop,
+    get_sorted_cells,
+    get_texts,
+    load_json,
+)
+
+# Times table assembly with and without the spatial index and checks both give
+# the same table. Pass saved model output as CELLS_JSON[:OCR_JSON], e.g. from
+# run_table_model(..., output_json_path=...), or leave it empty to use
+# synthetic dense frames.
+#
+# Also checks that cropping for OCR with get_ocr_crop keeps every text the table
+# needs. OCR on the crop is stood in for by the texts that are entirely inside
+# it, moved to crop coordinates.
+
+# size of the frames the saved model output is from
+FRAME_WIDTH = 1920
+FRAME_HEIGHT = 1080
+
+
+def get_synthetic_frame(
+    num_noise_cells: int, seed: int
+) -> tuple[dict[str, Any], dict[str, Any]]:
+    rng = random.Random(seed)
+    boxes = []
+    rec_texts = []
+    rec_boxes = []
+    x0 = rng.uniform(200, 800)
+    y0 = rng.uniform(50, 200)
+    size = rng.uniform(120, 160)
+    for row in range(5):
+        for col in range(5):
+            x_min = x0 + col * size + rng.uniform(-2, 2)
+            y_min = y0 + row * size + rng.uniform(-2, 2)
+            x_max = x_min + size + rng.uniform(-2, 2)
+            y_max = y_min + size + rng.uniform(-2, 2)
+            boxes.append({"label": "cell", "coordinate": [x_min, y_min, x_max, y_max]})
+            rec_texts.append(f"Goal number {row * 5 + col}: do the thing")
+            rec_boxes.append([x_min + 10, y_min + 40, x_max - 10, y_min + 70])
+    # boxes from the rest of the stream, some of them cell sized and lined up
+    # with each other
+    for _ in range(num_noise_cells):
+        width = rng.choice([size, rng.uniform(20, 400)])
+        height = rng.choice([size, rng.uniform(20, 400)])
+        x_min = rng.uniform(0, 1920 - width)
+        y_min = rng.uniform(0, 1080 - height)
+        boxes.append(
+            {
+                "label": "cell",
+                "coordinate": [x_min, y_min, x_min + width, y_min + height],
+            }
+        )
+        rec_texts.append("chat message")
+        rec_boxes.append([x_min, y_min, x_min + width / 2, y_min + 20])
+    return {"boxes": boxes}, {"rec_texts": rec_texts, "rec_boxes": rec_boxes}
+
+
+def get_sorted_cells_linear(
+    data: dict[str, Any], texts: list[Any]
+) -> list[Cell] | None:
+    cells = [
+        Cell(box["coordinate"], 0.2, texts, 0.05)
+        for box in data["boxes"]
+        if box["label"] == "cell"
+    ]
+    if len(cells) < 25:
+        return None
+    cells.sort(key=lambda cell: cell.taxi_dist)
+    return cells
+
+
+# the OCR output for the crop, from the OCR output for the whole frame
+def crop_ocr_data(
+    ocr_data: dict[str, Any], crop: tuple[int, int, int, int]
+) -> dict[str, Any]:
+    x_min, y_min, x_max, y_max = crop
+    rec_texts = []
+    rec_boxes = []
+    for text, box in zip(ocr_data["rec_texts"], ocr_data["rec_boxes"]):
+        if box[0] >= x_min and box[1] >= y_min and box[2] <= x_max and box[3] <= y_max:
+            rec_texts.append(text)
+            rec_boxes.append(
+                [box[0] - x_min, box[1] - y_min, box[2] - x_min, box[3] - y_min]
+            )
+    return {"rec_texts": rec_texts, "rec_boxes": rec_boxes}
+
+
+def describe(table: list[Cell] | None) -> Any:
+    if table is None:
+        return None
+    return [(c.x_min, c.y_min, c.x_max, c.y_max, c.text) for c in table]
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("frames", nargs="*", help="CELLS_JSON[:OCR_JSON]")
+parser.add_argument("--noise", type=int, default=400)
+args = parser.parse_args()
+
+frames: list[tuple[str, dict[str, Any], dict[str, Any]]] = []
+for arg in args.frames:
+    [cells_path, *ocr_path] = arg.split(":")
+    ocr_data = (
+        load_json(ocr_path[0]) if ocr_path else {"rec_texts": [], "rec_boxes": []}
+    )
+    frames.append((arg, load_json(cells_path), ocr_data))
+if len(frames) == 0:
+    for seed in range(5):
+        cell_data, ocr_data = get_synthetic_frame(args.noise, seed)
+        frames.append((f"synthetic {seed}", cell_data, ocr_data))
+
+for name, cell_data, ocr_data in frames:
+    texts = get_texts(ocr_data)
+    linear_cells = get_sorted_cells_linear(cell_data, texts)
+    indexed_cells = get_sorted_cells(cell_data, 0.2, texts, 0.05)
+    if linear_cells is None or indexed_cells is None:
+        print(f"{name}: fewer than 25 cells")
+        continue
+    if describe(linear_cells) != describe(indexed_cells):
+        raise Exception(f"Cell texts differ for {name}")
+    linear_table = find_table(linear_cells, use_index=False)
+    indexed_table = find_table(indexed_cells)
+    if describe(linear_table) != describe(indexed_table):
+        raise Exception(f"Tables differ for {name}")
+
+    linear_secs = min(
+        timeit.repeat(
+            lambda: find_table(get_sorted_cells_linear(cell_data, texts), False),
+            number=1,
+            repeat=3,
+        )
+    )
+    indexed_secs = min(
+        timeit.repeat(
+            lambda: find_table(get_sorted_cells(cell_data, 0.2, texts, 0.05)),
+            number=1,
+            repeat=3,
+        )
+    )
+    crop = get_ocr_crop(cell_data, 0.2, FRAME_WIDTH, FRAME_HEIGHT)
+    if crop is None:
+        if indexed_table is not None:
+            raise Exception(f"No crop for {name} but there's a table")
+        crop_description = "no crop"
+    else:
+        cropped = crop_ocr_data(ocr_data, crop)
+        cropped_texts = get_texts(cropped, crop[0], crop[1])
+        cropped_table = find_table(
+            get_sorted_cells(cell_data, 0.2, cropped_texts, 0.05)
+        )
+        if describe(cropped_table) != describe(indexed_table):
+            raise Exception(f"Tables differ with the crop for {name}")
+        crop_area = (crop[2] - crop[0]) * (crop[3] - crop[1])
+        crop_description = (
+            f"crop {100 * crop_area / (FRAME_WIDTH * FRAME_HEIGHT):.0f}% of the "
+            f"frame with {len(cropped_texts)} texts"
+        )
+
+    found = "found table" if indexed_table is not None else "no table"
+    print(
+        f"{name}: {len(linear_cells)} cells, {len(texts)} texts, {found}, "
+        f"linear {1000 * linear_secs:.1f} ms, indexed {1000 * indexed_secs:.1f} ms, "
+        f"{crop_description}"
+    )
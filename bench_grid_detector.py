@@ -0,0 +1,81 @@
+import glob
+import os
+import timeit
+
+import cv2
+
+from grid_detector import get_grid_score
+from match_with_video import CLEAR_GRID_SCORE, MIN_GRID_SCORE
+from square import deserialize_board_file
+
+# Scores every output/*/frame.png, checks where the grid was found against the
+# table in table.json, and times the detector. Some of the frames don't show
+# the board, so a missed table isn't always wrong. Each frame is scored again
+# with the table blurred out to see what the rest of the stream scores.
+
+# padding around the table that's blurred out, in pixels
+BLUR_PADDING = 20
+
+
+def get_overlap(
+    a: tuple[float, float, float, float], b: tuple[float, float, float, float]
+) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    return intersection / (area_a + area_b - intersection)
+
+
+found: list[float] = []
+missed: list[tuple[str, float]] = []
+blurred: list[float] = []
+secs: list[float] = []
+for frame_path in sorted(glob.glob(os.path.join("output", "*", "frame.png"))):
+    table_path = os.path.join(os.path.dirname(frame_path), "table.json")
+    if not os.path.isfile(table_path):
+        continue
+    frame = cv2.imread(frame_path)
+    table = deserialize_board_file(table_path)
+    table_bounds = (
+        min(square.x_min for square in table),
+        min(square.y_min for square in table),
+        max(square.x_max for square in table),
+        max(square.y_max for square in table),
+    )
+    secs.append(min(timeit.repeat(lambda: get_grid_score(frame), number=1, repeat=3)))
+    grid_score = get_grid_score(frame)
+    if (
+        grid_score.bounds is not None
+        and get_overlap(grid_score.bounds, table_bounds) >= 0.7
+    ):
+        found.append(grid_score.score)
+    else:
+        missed.append((frame_path, grid_score.score))
+
+    x_min, y_min, x_max, y_max = [int(v) for v in table_bounds]
+    rows = slice(max(0, y_min - BLUR_PADDING), y_max + BLUR_PADDING)
+    cols = slice(max(0, x_min - BLUR_PADDING), x_max + BLUR_PADDING)
+    frame[rows, cols] = cv2.GaussianBlur(frame[rows, cols], (0, 0), 15)
+    blurred.append(get_grid_score(frame).score)
+
+print(
+    f"{len(found) + len(missed)} frames, {1000 * sum(secs) / len(secs):.1f} ms "
+    f"per frame on average, {1000 * max(secs):.1f} ms at most"
+)
+print(
+    f"Table found in {len(found)}, {sum(s >= CLEAR_GRID_SCORE for s in found)} "
+    f"of them scoring at least {CLEAR_GRID_SCORE} and "
+    f"{sum(s < MIN_GRID_SCORE for s in found)} under {MIN_GRID_SCORE}"
+)
+print(f"Table not found in {len(missed)}:")
+for frame_path, score in missed:
+    print(f"    {frame_path}: {score:.2f}")
+print(
+    f"With the table blurred out, {sum(s >= CLEAR_GRID_SCORE for s in blurred)} "
+    f"scored at least {CLEAR_GRID_SCORE} and "
+    f"{sum(s >= MIN_GRID_SCORE for s in blurred)} at least {MIN_GRID_SCORE}"
+)
@@ -0,0 +1,60 @@
+import json
+import subprocess
+import sys
+import time
+
+# Times a fresh interpreter importing what each script imports, and lists
+# which of the heavy video and OCR modules came along with it. The reporting
+# scripts shouldn't load any of them.
+
+HEAVY_MODULES = ["numpy", "cv2", "paddleocr", "paddle", "PIL"]
+IMPORTS = {
+    "goal_completions.py": [
+        "changelog",
+        "color",
+        "make_url",
+        "match",
+        "parse_csv",
+        "square",
+        "text_correction",
+    ],
+    "create_text_corrections.py": [
+        "changelog",
+        "match",
+        "parse_csv",
+        "color",
+        "square",
+        "text_correction",
+    ],
+    # what the reporting scripts used to pay for
+    "match_with_video + paddleocr": ["match_with_video", "paddleocr"],
+}
+NUM_RUNS = 5
+
+code = f"""
+import json, sys, time
+start_time = time.perf_counter()
+import {{modules}}
+elapsed_time = time.perf_counter() - start_time
+print(json.dumps([elapsed_time, [m for m in {HEAVY_MODULES} if m in sys.modules]]))
+"""
+
+for name, modules in IMPORTS.items():
+    import_secs = []
+    total_secs = []
+    loaded: list[str] = []
+    for _ in range(NUM_RUNS):
+        start_time = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", code.format(modules=", ".join(modules))],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        total_secs.append(time.perf_counter() - start_time)
+        elapsed_time, loaded = json.loads(output.splitlines()[-1])
+        import_secs.append(elapsed_time)
+    print(
+        f"{name}: imports {1000 * min(import_secs):.0f} ms, process "
+        f"{1000 * min(total_secs):.0f} ms, heavy modules loaded: {loaded or 'none'}"
+    )
@@ -0,0 +1,90 @@
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+
+from benchmark import SyntheticMatch
+from changelog import Change
+from match import Match
+from match_with_video import MatchWithVideo
+from sampling import SamplerMode, SamplingOptions
+from square import serialize_board_to_file
+
+# Checks that sampling a match in shards gives exactly the changelog a serial
+# run does. Renders synthetic matches like benchmark.py, with popups covering
+# the board so the transition filter has something to throw away, and runs
+# every shard count with the seeking and the sequential sampler. Raises on the
+# first changelog that differs from the serial seeking one.
+#
+#   python bench_shards.py --seeds 0 1 2
+
+SHARD_COUNTS = [1, 2, 3]
+
+
+def get_changelog(
+    match: Match, video_filename: str, options: SamplingOptions
+) -> list[Change]:
+    with_video = MatchWithVideo(match, video_filename)
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, changelog = with_video.get_changelog(options)
+    with_video.cap.release()
+    return changelog
+
+
+def describe(changelog: list[Change]) -> list[tuple[float, int, str]]:
+    return [
+        (change.time, change.square_index, change.color.name) for change in changelog
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--secs", type=int, default=240)
+    args = parser.parse_args()
+
+    for seed in args.seeds:
+        settings = argparse.Namespace(
+            width=640,
+            height=360,
+            fps=30,
+            secs=args.secs,
+            noise=True,
+            seed=seed,
+            change_secs=15,
+        )
+        synthetic = SyntheticMatch(settings)
+        with tempfile.TemporaryDirectory() as output_root:
+            match = Match(synthetic.row, output_root)
+            video_filename = os.path.join(match.dir, "video.mp4")
+            serialize_board_to_file(
+                synthetic.table, os.path.join(match.dir, "table.json")
+            )
+            synthetic.render(video_filename, "mp4v", 0)
+
+            expected = None
+            for mode in [SamplerMode.SEEK, SamplerMode.SEQUENTIAL]:
+                for shards in SHARD_COUNTS:
+                    changelog = describe(
+                        get_changelog(
+                            match,
+                            video_filename,
+                            SamplingOptions(mode=mode, shards=shards),
+                        )
+                    )
+                    if expected is None:
+                        expected = changelog
+                    if changelog != expected:
+                        raise Exception(
+                            f"Seed {seed}, {mode.value} with {shards} shards: "
+                            f"got {changelog}, expected {expected}"
+                        )
+                    print(
+                        f"Seed {seed}, {mode.value} with {shards} shards: "
+                        f"{len(changelog)} changes match"
+                    )
+
+
+if __name__ == "__main__":
+    main()
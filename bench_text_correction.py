@@ -0,0 +1,45 @@
+import difflib
+import os
+import timeit
+
+from parse_csv import get_all_matches
+from square import deserialize_board_file
+from text_correction import corrections, goal_index, stripped_goals, strip_text
+
+# Checks GoalIndex.get_close_matches against difflib.get_close_matches on every
+# text in corrections.json and every table text, and times both.
+
+NUM_MATCHES = [1, 3, 5]
+CUTOFF = 0.2
+
+texts = set(corrections)
+for match in get_all_matches():
+    table_path = os.path.join(match.dir, "table.json")
+    if os.path.isfile(table_path):
+        texts.update(square.text for square in deserialize_board_file(table_path))
+words = sorted(strip_text(text) for text in texts)
+
+for n in NUM_MATCHES:
+    for word in words:
+        expected = difflib.get_close_matches(word, stripped_goals, n, CUTOFF)
+        if goal_index.get_close_matches(word, n, CUTOFF) != expected:
+            raise Exception(f"Matches differ for {word!r} with n={n}")
+
+
+def run_difflib():
+    for word in words:
+        difflib.get_close_matches(word, stripped_goals, 3, CUTOFF)
+
+
+def run_index():
+    for word in words:
+        goal_index.get_close_matches(word, 3, CUTOFF)
+
+
+difflib_secs = timeit.timeit(run_difflib, number=1)
+index_secs = timeit.timeit(run_index, number=1)
+print(
+    f"{len(words)} texts against {len(stripped_goals)} goals: difflib "
+    f"{len(words) / difflib_secs:.0f} texts/s, index {len(words) / index_secs:.0f} "
+    f"texts/s"
+)
@@ -0,0 +1,389 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import time
+import cv2
+import numpy
+
+from changelog import Change
+from color import Color
+from match import GoalCompletion, Match
+from match_with_video import SAMPLE_STEP, MatchWithVideo
+from sampling import SamplerMode, SamplingOptions, get_sample_times
+from square import Square, serialize_board_to_file
+from video import CellMeanExtractor, get_reference_colors, get_reference_palette
+
+# Renders a synthetic match, a 5x5 board of swatch colors with scripted
+# changes, and times the pipeline on it, so speed can be measured without
+# downloading a VOD. Results go to a JSON file so runs can be compared.
+#
+#   python benchmark.py --secs 300 --samplers seek sequential ffmpeg
+
+P1_COLOR = Color.RED
+P2_COLOR = Color.BLUE
+BOARD_START = 10
+# changes are at least this far apart so each one shows up in its own sample
+MIN_CHANGE_GAP = SAMPLE_STEP + 1
+
+
+class SyntheticMatch:
+    def __init__(self, args: argparse.Namespace):
+        self.width = args.width
+        self.height = args.height
+        self.fps = args.fps
+        self.num_frames = args.secs * args.fps
+        self.noise = args.noise
+        self.rng = random.Random(args.seed)
+
+        size = min(0.6 * self.width, 0.84 * self.height) / 5
+        x0 = round(0.25 * self.width)
+        y0 = round(0.08 * self.height)
+        gap = max(2, round(size / 30))
+        self.table = [
+            Square(
+                x_min=float(round(x0 + col * size)),
+                y_min=float(round(y0 + row * size)),
+                x_max=float(round(x0 + (col + 1) * size) - gap),
+                y_max=float(round(y0 + (row + 1) * size) - gap),
+                text=f"Synthetic goal {5 * row + col}",
+            )
+            for row in range(5)
+            for col in range(5)
+        ]
+        self.changelog = self.get_script(args.change_secs)
+        self.row = self.get_row()
+
+    # one change every change_secs on average, each to a different color than
+    # the square had, with the odd square cleared again
+    def get_script(self, change_secs: float) -> list[Change]:
+        board = [Color.BLACK] * 25
+        changelog: list[Change] = []
+        change_time = BOARD_START + self.rng.uniform(MIN_CHANGE_GAP, 2 * change_secs)
+        while change_time < self.num_frames / self.fps - MIN_CHANGE_GAP:
+            square_index = self.rng.randrange(25)
+            if board[square_index] != Color.BLACK and self.rng.random() < 0.15:
+                color = Color.BLACK
+            else:
+                color = self.rng.choice(
+                    [c for c in [P1_COLOR, P2_COLOR] if c != board[square_index]]
+                )
+            board[square_index] = color
+            # on a frame boundary, so the changelog says exactly when it shows
+            frame_index = round(change_time * self.fps)
+            changelog.append(Change(frame_index / self.fps, square_index, color))
+            change_time += max(MIN_CHANGE_GAP, self.rng.expovariate(1 / change_secs))
+        return changelog
+
+    # a CSV row whose final score agrees with the script, so write_changelog's
+    # check means something
+    def get_row(self) -> list[str]:
+        stats = GoalCompletion.get_final_stats(self.changelog, "")
+        if stats is None:
+            stats = (P1_COLOR, 0, False, P2_COLOR, 0)
+        _, winner_score, bingo, _, loser_score = stats
+        return [
+            "bench",
+            "",
+            "synthetic",
+            "board",
+            "",
+            "",
+            "0",
+            str(BOARD_START),
+            "",
+            str(winner_score),
+            str(loser_score),
+            "P1" if bingo else "",
+            "synthetic",
+            "",
+        ]
+
+    def render(self, video_filename: str, codec: str, keyframe_interval: int):
+        params = []
+        if keyframe_interval > 0:
+            params = [cv2.VIDEOWRITER_PROP_KEY_INTERVAL, keyframe_interval]
+        writer = cv2.VideoWriter(
+            video_filename,
+            cv2.CAP_FFMPEG,
+            cv2.VideoWriter.fourcc(*codec),
+            self.fps,
+            (self.width, self.height),
+            params,
+        )
+        if not writer.isOpened():
+            raise Exception(f"Can't write {video_filename} with codec {codec}")
+        swatches = {
+            color: bgrs[0][:3] for color, bgrs in get_reference_colors().items()
+        }
+        board = [Color.BLACK] * 25
+        changes_by_frame: dict[int, list[Change]] = {}
+        for change in self.changelog:
+            frame_index = round(change.time * self.fps)
+            changes_by_frame.setdefault(frame_index, []).append(change)
+        webcam_width = self.width // 6
+        noise = numpy.random.default_rng(0).integers(
+            0, 64, (2 * self.height, webcam_width, 3), dtype=numpy.uint8
+        )
+        # a popup over the middle three rows every minute, like a sub
+        # notification. It starts on a sample time and covers enough squares
+        # that sampling has to throw that sample away
+        popup = (self.table[5], self.table[19])
+        popup_frames = 3 * self.fps // 2
+        popup_every = 60 * self.fps
+
+        background = numpy.full((self.height, self.width, 3), 40, numpy.uint8)
+        board_frame = background
+        for frame_index in range(self.num_frames):
+            if frame_index == 0 or frame_index in changes_by_frame:
+                for change in changes_by_frame.get(frame_index, []):
+                    board[change.square_index] = change.color
+                board_frame = background.copy()
+                for square, color in zip(self.table, board):
+                    top_left = (int(square.x_min), int(square.y_min))
+                    bottom_right = (int(square.x_max), int(square.y_max))
+                    cv2.rectangle(
+                        board_frame, top_left, bottom_right, swatches[color], -1
+                    )
+                    cv2.putText(
+                        board_frame,
+                        square.text,
+                        (top_left[0] + 4, (top_left[1] + bottom_right[1]) // 2),
+                        cv2.FONT_HERSHEY_SIMPLEX,
+                        0.3,
+                        (255, 255, 255),
+                        1,
+                    )
+            frame = board_frame
+            if self.noise:
+                frame = board_frame.copy()
+                offset = frame_index % self.height
+                frame[:, :webcam_width] = noise[offset : offset + self.height]
+                if frame_index % popup_every < popup_frames and frame_index > 0:
+                    cv2.rectangle(
+                        frame,
+                        (int(popup[0].x_min), int(popup[0].y_min)),
+                        (int(popup[1].x_max), int(popup[1].y_max)),
+                        (0, 220, 255),
+                        -1,
+                    )
+            writer.write(frame)
+        writer.release()
+
+
+# returns (seconds, what fn returned, what fn printed)
+def time_call(fn) -> tuple[float, object, str]:
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        start_time = time.perf_counter()
+        result = fn()
+        elapsed_time = time.perf_counter() - start_time
+    return elapsed_time, result, log.getvalue()
+
+
+def describe(changelog: list[Change]) -> list[tuple[int, Color]]:
+    return [(change.square_index, change.color) for change in changelog]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-root", default="benchmark_output")
+    parser.add_argument(
+        "--results",
+        default=None,
+        help="where to write the JSON results, default <output root>/results.json",
+    )
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--secs", type=int, default=300, help="length of the video")
+    parser.add_argument("--codec", default="mp4v", help="fourcc for cv2.VideoWriter")
+    parser.add_argument(
+        "--keyframe-interval",
+        type=int,
+        default=0,
+        help="frames between keyframes, 0 for the encoder's default",
+    )
+    parser.add_argument(
+        "--change-secs", type=float, default=20, help="average time between changes"
+    )
+    parser.add_argument(
+        "--noise",
+        action="store_true",
+        help="add a noisy webcam and popups that cover the board",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--samplers",
+        type=SamplerMode,
+        nargs="+",
+        default=[SamplerMode.SEEK, SamplerMode.SEQUENTIAL],
+    )
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--pipeline-size", type=int, default=0)
+    parser.add_argument("--diff-threshold", type=float, default=None)
+    parser.add_argument(
+        "--rerender",
+        action="store_true",
+        help="render the video even if one with the same settings exists",
+    )
+    args = parser.parse_args()
+
+    synthetic = SyntheticMatch(args)
+    match = Match(synthetic.row, args.output_root)
+    extension = "mkv" if args.codec.lower() in ["ffv1", "h264", "x264"] else "mp4"
+    video_filename = os.path.join(match.dir, f"video.{extension}")
+    render_settings = {
+        name: getattr(args, name)
+        for name in [
+            "width",
+            "height",
+            "fps",
+            "secs",
+            "codec",
+            "keyframe_interval",
+            "change_secs",
+            "noise",
+            "seed",
+        ]
+    }
+    settings_name = os.path.join(match.dir, "render_settings.json")
+    stages: list[dict] = []
+
+    rendered = os.path.isfile(settings_name) and os.path.isfile(video_filename)
+    if rendered:
+        with open(settings_name, "r") as file:
+            rendered = json.load(file) == render_settings
+    if args.rerender or not rendered:
+        for fname in os.listdir(match.dir):
+            os.remove(os.path.join(match.dir, fname))
+        serialize_board_to_file(synthetic.table, os.path.join(match.dir, "table.json"))
+        elapsed_time, _, _ = time_call(
+            lambda: synthetic.render(video_filename, args.codec, args.keyframe_interval)
+        )
+        with open(settings_name, "w") as file:
+            json.dump(render_settings, file)
+        stages.append(
+            {
+                "stage": "render",
+                "secs": elapsed_time,
+                "frames": synthetic.num_frames,
+                "frames_per_sec": synthetic.num_frames / elapsed_time,
+            }
+        )
+        print(f"Rendered {synthetic.num_frames} frames in {elapsed_time:.1f}s")
+
+    # raw decode speed, for comparing the samplers against
+    cap = cv2.VideoCapture(video_filename)
+    start_time = time.perf_counter()
+    decoded = 0
+    while decoded < min(synthetic.num_frames, 30 * args.fps) and cap.grab():
+        decoded += 1
+    decode_secs = time.perf_counter() - start_time
+    frame = None
+    if decoded > 0:
+        _, frame = cap.retrieve()
+    cap.release()
+    stages.append(
+        {
+            "stage": "decode",
+            "secs": decode_secs,
+            "frames": decoded,
+            "frames_per_sec": decoded / decode_secs,
+        }
+    )
+
+    # the classifier on its own: cell means of a frame, then nearest swatch
+    palette = get_reference_palette()
+    color_mask = palette.get_mask(None)
+    if frame is not None:
+        extractor = CellMeanExtractor(synthetic.table)
+        num_calls = 1000
+        means = extractor.get_means(frame)
+        for name, fn in [
+            ("cell_means", lambda: extractor.get_means(frame)),
+            ("classify", lambda: palette.classify(means, color_mask)),
+        ]:
+            elapsed_time, _, _ = time_call(lambda: [fn() for _ in range(num_calls)])
+            stages.append(
+                {
+                    "stage": name,
+                    "secs": elapsed_time,
+                    "calls": num_calls,
+                    "usecs_per_call": 1e6 * elapsed_time / num_calls,
+                }
+            )
+
+    num_samples = len(
+        get_sample_times(BOARD_START, synthetic.num_frames / args.fps, SAMPLE_STEP)
+    )
+    for sampler in args.samplers:
+        options = SamplingOptions(
+            mode=sampler,
+            shards=args.shards,
+            diff_threshold=args.diff_threshold,
+            pipeline_size=args.pipeline_size,
+        )
+        for stage in ["get_distinct_states", "get_changelog"]:
+            with_video = MatchWithVideo(match, video_filename)
+            if stage == "get_distinct_states":
+                elapsed_time, states, log = time_call(
+                    lambda: with_video.get_distinct_states(options)
+                )
+                result = {"states": len(states)}
+            else:
+                elapsed_time, (final_score_matches, changelog), log = time_call(
+                    lambda: with_video.get_changelog(options)
+                )
+                result = {
+                    "changes": len(changelog),
+                    "changelog_matches_script": describe(changelog)
+                    == describe(synthetic.changelog),
+                    "final_score_matches": final_score_matches,
+                }
+            with_video.cap.release()
+            stages.append(
+                {
+                    "stage": stage,
+                    "sampler": sampler.value,
+                    "secs": elapsed_time,
+                    "samples": num_samples,
+                    "samples_per_sec": num_samples / elapsed_time,
+                    **result,
+                }
+            )
+            if result.get("changelog_matches_script") is False:
+                print(log, end="")
+
+    results = {
+        "time": time.time(),
+        "python": sys.version.split()[0],
+        "opencv": cv2.__version__,
+        "cpus": os.cpu_count(),
+        "settings": {
+            **render_settings,
+            "shards": args.shards,
+            "pipeline_size": args.pipeline_size,
+            "diff_threshold": args.diff_threshold,
+        },
+        "scripted_changes": len(synthetic.changelog),
+        "stages": stages,
+    }
+    results_name = args.results or os.path.join(args.output_root, "results.json")
+    with open(results_name, "w") as file:
+        json.dump(results, file, indent=2)
+    for stage in stages:
+        print(
+            ", ".join(
+                f"{key} {value:.4g}" if isinstance(value, float) else f"{key} {value}"
+                for key, value in stage.items()
+            )
+        )
+    print(f"Wrote {results_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from typing import Iterator
+
+from color import Color
+
+# A board is one 25 bit mask per color, with bit i set when square i is that
+# color. Black squares are the ones in no mask. Finding a bingo and counting
+# squares are then a few int operations instead of loops over the squares.
+# Indexing and iterating give Colors, so a Board can be used anywhere a
+# list[Color] of the squares was.
+
+NUM_SQUARES = 25
+
+
+def get_mask(square_indices: list[int]) -> int:
+    mask = 0
+    for index in square_indices:
+        mask |= 1 << index
+    return mask
+
+
+# in the order bingos are looked for, so the first line found doesn't change
+BINGO_LINES = [
+    # rows
+    *[get_mask([5 * row + col for col in range(5)]) for row in range(5)],
+    # columns
+    *[get_mask([5 * row + col for row in range(5)]) for col in range(5)],
+    # diagonals
+    get_mask([0, 6, 12, 18, 24]),
+    get_mask([4, 8, 12, 16, 20]),
+]
+
+
+def get_lowest_square(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+
+def get_squares(mask: int) -> list[int]:
+    squares: list[int] = []
+    while mask:
+        lowest = mask & -mask
+        squares.append(lowest.bit_length() - 1)
+        mask ^= lowest
+    return squares
+
+
+class Board:
+    def __init__(self, masks: dict[Color, int] | None = None):
+        # never has BLACK or an empty mask, so equal boards have equal dicts
+        self.masks: dict[Color, int] = {}
+        if masks is not None:
+            self.masks = {
+                color: mask
+                for color, mask in masks.items()
+                if color != Color.BLACK and mask != 0
+            }
+
+    @staticmethod
+    def from_colors(colors: list[Color]) -> "Board":
+        board = Board()
+        masks = board.masks
+        bit = 1
+        for color in colors:
+            if color is not Color.BLACK:
+                masks[color] = masks.get(color, 0) | bit
+            bit <<= 1
+        return board
+
+    def __len__(self) -> int:
+        return NUM_SQUARES
+
+    def __getitem__(self, index: int) -> Color:
+        if index < 0:
+            index += NUM_SQUARES
+        if not 0 <= index < NUM_SQUARES:
+            raise IndexError("Board index out of range")
+        bit = 1 << index
+        for color, mask in self.masks.items():
+            if mask & bit:
+                return color
+        return Color.BLACK
+
+    def __iter__(self) -> Iterator[Color]:
+        colors = [Color.BLACK] * NUM_SQUARES
+        for color, mask in self.masks.items():
+            for index in get_squares(mask):
+                colors[index] = color
+        return iter(colors)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Board):
+            return self.masks == other.masks
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Board({list(self)})"
+
+    # the lowest square of the first line in BINGO_LINES that's all one color
+    def get_bingo_first_square(self) -> int | None:
+        for line in BINGO_LINES:
+            for mask in self.masks.values():
+                if mask & line == line:
+                    return get_lowest_square(line)
+        return None
+
+    # (color, number of squares) for every color on the board, most squares
+    # first. Ties go to the color with the lowest square, which is the order
+    # Counter.most_common gave when counting the squares in order.
+    def get_scores(self) -> list[tuple[Color, int]]:
+        return [
+            (color, mask.bit_count())
+            for color, mask in sorted(
+                self.masks.items(),
+                key=lambda item: (-item[1].bit_count(), item[1] & -item[1]),
+            )
+        ]
@@ -23,11 +23,13 @@ def get_changelog_from_tuples(tuples: list[tuple[float, int, Color]]) -> list[Ch
 def serialize_changelog(changelog: list[Change]) -> str:
     lines: list[str] = []
     for change in changelog:
-        hrs = math.trunc(change.time / 3600)
-        remaining = change.time - 3600 * hrs
+        # keep hundredths so refined change times survive a round trip, and
+        # round first so 59.999 doesn't print as 0:00:60.00
+        time = round(change.time, 2)
+        hrs = math.trunc(time / 3600)
+        remaining = time - 3600 * hrs
         mins = math.trunc(remaining / 60)
-        remaining = remaining - 60 * mins
-        secs = round(remaining)
+        secs = remaining - 60 * mins
         lines.append(
             f"{hrs}:{mins:02d}:{secs:05.2f} - {change.square_index} - {change.color.value}"
         )
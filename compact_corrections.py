@@ -0,0 +1,6 @@
+from text_correction import compact_corrections
+
+# Folds corrections.jsonl into corrections.json. create_text_corrections does
+# this when it finishes, so this is for when it didn't get that far.
+
+compact_corrections()
@@ -4,8 +4,16 @@ from match import GoalCompletion
 from parse_csv import get_all_matches
 from color import Color
 from square import deserialize_board_file
-from text_correction import add_correction, get_best_matches, get_confirmed_text
+from text_correction import (
+    add_correction,
+    compact_corrections,
+    get_all_best_matches,
+    get_confirmed_text,
+)
 
+# find every text that needs a correction first and look up their suggestions
+# together, so there's no wait between questions
+pending: list[tuple[str, str]] = []
 matches = get_all_matches()
 for match in matches:
     changelog_path = os.path.join(match.dir, "changelog.txt")
@@ -22,14 +30,24 @@ for match in matches:
         text = table[i].text
         if get_confirmed_text(text) is not None:
             continue
-        print(f"For frame {os.path.join(match.dir, "frame.png")}")
-        best_matches = get_best_matches(text, 3)
-        print("   " + text)
-        for i in range(len(best_matches)):
-            print(f"{i+1}. {best_matches[i]}")
-        best = input("Which is best? ")
-        if best != "1" and best != "2" and best != "3":
-            print("Skipping...")
-            continue
-        best_index = int(best) - 1
-        add_correction(text, best_matches[best_index])
+        pending.append((match.dir, text))
+
+all_best_matches = get_all_best_matches([text for _, text in pending], 3)
+for match_dir, text in pending:
+    # the same text can come up more than once
+    if get_confirmed_text(text) is not None:
+        continue
+    print(f"For frame {os.path.join(match_dir, "frame.png")}")
+    best_matches = all_best_matches[text]
+    print("   " + text)
+    for i in range(len(best_matches)):
+        print(f"{i+1}. {best_matches[i]}")
+    best = input("Which is best? ")
+    if best != "1" and best != "2" and best != "3":
+        print("Skipping...")
+        continue
+    best_index = int(best) - 1
+    add_correction(text, best_matches[best_index])
+
+# fold this session's corrections into corrections.json
+compact_corrections()
@@ -1,11 +1,18 @@
+import bisect
+import cv2
 import json
+import os
+import time
 import numpy as numpy
-from paddleocr import PaddleOCR, TableCellsDetection
-from PIL import Image, ImageDraw
-from typing import Any
+from typing import TYPE_CHECKING, Any, Callable
 
+import telemetry
 from square import Square
 
+# paddleocr takes seconds to import, so it's only imported once a model is built
+if TYPE_CHECKING:
+    from paddleocr import PaddleOCR, TableCellsDetection
+
 
 def approx(a: float, b: float, tolerance: float) -> bool:
     return abs(a - b) <= tolerance
@@ -20,6 +27,21 @@ class Box:
         self.taxi_dist = (self.x_max + self.x_min) / 2 + (self.y_max + self.y_min) / 2
 
 
+# Sorts boxes by one of their edges so the boxes with that edge in a range can
+# be found with a binary search instead of checking every box
+class EdgeIndex:
+    def __init__(self, boxes: list[Box], edge: Callable[[Box], float]):
+        self.order = sorted(range(len(boxes)), key=lambda i: edge(boxes[i]))
+        self.edges = [edge(boxes[i]) for i in self.order]
+
+    # returns indices into boxes in increasing order, so callers see matches in
+    # the same order as a linear scan would
+    def get_between(self, low: float, high: float) -> list[int]:
+        start = bisect.bisect_left(self.edges, low)
+        end = bisect.bisect_right(self.edges, high)
+        return sorted(self.order[start:end])
+
+
 class Cell(Box):
     def __init__(
         self,
@@ -27,11 +49,12 @@ class Cell(Box):
         pos_tolerance: float,
         texts: list["Text"],
         text_tolerance: float,
+        text_index: EdgeIndex | None = None,
     ):
         Box.__init__(self, coords)
         self.x_tolerance = (self.x_max - self.x_min) * pos_tolerance
         self.y_tolerance = (self.y_max - self.y_min) * pos_tolerance
-        self.text = self.get_contained_text(texts, text_tolerance)
+        self.text = self.get_contained_text(texts, text_tolerance, text_index)
 
     def is_right_neighbor(self, other: "Cell") -> bool:
         return (
@@ -69,8 +92,26 @@ class Cell(Box):
             and self.y_max + y_tolerance > other.y_max
         )
 
-    def get_contained_text(self, texts: list["Text"], tolerance: float) -> str:
-        return " ".join([t.text for t in texts if self.contains(t, tolerance)])
+    # text_index should index texts by x_min
+    def get_contained_text(
+        self,
+        texts: list["Text"],
+        tolerance: float,
+        text_index: EdgeIndex | None = None,
+    ) -> str:
+        candidates = texts
+        if text_index is not None:
+            # a contained text starts after our left edge and, since it ends
+            # before our right edge, also starts before it. Pad by a pixel so
+            # rounding never drops a text contains() would accept.
+            x_tolerance = (self.x_max - self.x_min) * tolerance + 1
+            candidates = [
+                texts[i]
+                for i in text_index.get_between(
+                    self.x_min - x_tolerance, self.x_max + x_tolerance
+                )
+            ]
+        return " ".join([t.text for t in candidates if self.contains(t, tolerance)])
 
 
 class Text(Box):
@@ -79,14 +120,60 @@ class Text(Box):
         Box.__init__(self, coords)
 
 
+# Building the models is slow, so keep one of each per config around for the
+# whole process instead of building them again on every call
+loaded_models: dict[tuple[str, tuple[tuple[str, Any], ...]], Any] = {}
+
+
+def get_model(model_class: type, **kwargs: Any) -> Any:
+    key = (model_class.__name__, tuple(sorted(kwargs.items())))
+    model = loaded_models.get(key)
+    if model is None:
+        start_time = time.perf_counter()
+        with telemetry.stage("model_build"):
+            model = model_class(**kwargs)
+        elapsed_time = time.perf_counter() - start_time
+        print(f"Built {model_class.__name__} in {elapsed_time:.2f}s")
+        loaded_models[key] = model
+    return model
+
+
+def get_table_model() -> "TableCellsDetection":
+    from paddleocr import TableCellsDetection
+
+    return get_model(TableCellsDetection, model_name="RT-DETR-L_wired_table_cell_det")
+
+
+def get_ocr_model() -> "PaddleOCR":
+    from paddleocr import PaddleOCR
+
+    return get_model(
+        PaddleOCR,
+        # trying to fix test2.png processing
+        # text_det_limit_side_len=3840,
+        use_doc_orientation_classify=False,
+        use_doc_unwarping=False,
+        use_textline_orientation=False,
+    )
+
+
+# build the models ahead of time so the first OCR attempt isn't slower
+def warm_models():
+    get_table_model()
+    get_ocr_model()
+
+
+def release_models():
+    loaded_models.clear()
+
+
+# img can be an image path or a decoded BGR frame
 def run_table_model(
-    img_path: str,
+    img: str | numpy.ndarray,
     output_img_path: str | None = None,
     output_json_path: str | None = None,
 ) -> dict[str, Any]:
-    model = TableCellsDetection(model_name="RT-DETR-L_wired_table_cell_det")
-    output = model.predict(img_path, threshold=0.3, batch_size=1)
-    res = output[0]
+    res = run_table_model_batch([img])[0]
     if output_img_path is not None:
         res.save_to_img(output_img_path)
     if output_json_path is not None:
@@ -94,21 +181,26 @@ def run_table_model(
     return res
 
 
+# one predict call for all of imgs, so the model's per call overhead is paid
+# once and the backend can spread the batch over every core
+def run_table_model_batch(imgs: list[str | numpy.ndarray]) -> list[dict[str, Any]]:
+    model = get_table_model()
+    start_time = time.perf_counter()
+    with telemetry.stage("table_model"):
+        output = list(model.predict(imgs, threshold=0.3, batch_size=len(imgs)))
+    print(
+        f"Table model inference took {time.perf_counter() - start_time:.2f}s"
+        + (f" for {len(imgs)} images" if len(imgs) > 1 else "")
+    )
+    return output
+
+
 def run_ocr_model(
-    img_path: str,
+    img: str | numpy.ndarray,
     output_img_path: str | None = None,
     output_json_path: str | None = None,
 ) -> dict[str, Any]:
-    ocr = PaddleOCR(
-        # trying to fix test2.png processing
-        # text_det_limit_side_len=3840,
-        use_doc_orientation_classify=False,
-        use_doc_unwarping=False,
-        use_textline_orientation=False,
-    )
-    output = ocr.predict(input=img_path)
-
-    res = output[0]
+    res = run_ocr_model_batch([img])[0]
     if output_img_path is not None:
         res.save_to_img(output_img_path)
     if output_json_path is not None:
@@ -116,6 +208,18 @@ def run_ocr_model(
     return res
 
 
+def run_ocr_model_batch(imgs: list[str | numpy.ndarray]) -> list[dict[str, Any]]:
+    ocr = get_ocr_model()
+    start_time = time.perf_counter()
+    with telemetry.stage("ocr"):
+        output = list(ocr.predict(input=imgs))
+    print(
+        f"OCR model inference took {time.perf_counter() - start_time:.2f}s"
+        + (f" for {len(imgs)} images" if len(imgs) > 1 else "")
+    )
+    return output
+
+
 def load_json(json_path: str) -> dict[str, Any]:
     with open(json_path, "r") as file:
         return json.load(file)
@@ -124,8 +228,9 @@ def load_json(json_path: str) -> dict[str, Any]:
 def get_sorted_cells(
     data: dict[str, Any], pos_tolerance: float, texts: list[Text], text_tolerance: float
 ) -> list[Cell] | None:
+    text_index = EdgeIndex(texts, lambda t: t.x_min)
     cells = [
-        Cell(box["coordinate"], pos_tolerance, texts, text_tolerance)
+        Cell(box["coordinate"], pos_tolerance, texts, text_tolerance, text_index)
         for box in data["boxes"]
         if box["label"] == "cell"
     ]
@@ -151,8 +256,42 @@ def find_bottom_cell(cells: list[Cell], index: int) -> int | None:
     return None
 
 
+# Same results as find_right_cell and find_bottom_cell, but only checks cells
+# whose left (or top) edge is near this cell's right (or bottom) edge
+class CellIndex:
+    def __init__(self, cells: list[Cell]):
+        self.cells = cells
+        self.by_x_min = EdgeIndex(cells, lambda c: c.x_min)
+        self.by_y_min = EdgeIndex(cells, lambda c: c.y_min)
+
+    def find_right_cell(self, index: int) -> int | None:
+        cell = self.cells[index]
+        # pad by a pixel so rounding never drops a cell approx() would accept
+        tolerance = cell.x_tolerance + 1
+        candidates = self.by_x_min.get_between(
+            cell.x_max - tolerance, cell.x_max + tolerance
+        )
+        for i in candidates:
+            if i > index and cell.is_right_neighbor(self.cells[i]):
+                return i
+        return None
+
+    def find_bottom_cell(self, index: int) -> int | None:
+        cell = self.cells[index]
+        tolerance = cell.y_tolerance + 1
+        candidates = self.by_y_min.get_between(
+            cell.y_max - tolerance, cell.y_max + tolerance
+        )
+        for i in candidates:
+            if i > index and cell.is_bottom_neighbor(self.cells[i]):
+                return i
+        return None
+
+
 # test if the cell at the given index can be the top left cell of a 5x5 table
-def find_table_from_index(cells: list[Cell], index: int) -> None | list[int]:
+def find_table_from_index(
+    cells: list[Cell], index: int, cell_index: CellIndex | None = None
+) -> None | list[int]:
     table = [index]
     cur_row_start = index
     prev_cell = index
@@ -160,14 +299,20 @@ def find_table_from_index(cells: list[Cell], index: int) -> None | list[int]:
     for i in range(1, 25):
         # every fifth cell should be trying to add a new row instead of a new co
         if i % 5 == 0:
-            new_bottom = find_bottom_cell(cells, cur_row_start)
+            if cell_index is None:
+                new_bottom = find_bottom_cell(cells, cur_row_start)
+            else:
+                new_bottom = cell_index.find_bottom_cell(cur_row_start)
             if new_bottom is None:
                 return None
             cur_row_start = new_bottom
             prev_cell = new_bottom
             table.append(new_bottom)
         else:
-            new_right = find_right_cell(cells, prev_cell)
+            if cell_index is None:
+                new_right = find_right_cell(cells, prev_cell)
+            else:
+                new_right = cell_index.find_right_cell(prev_cell)
             if new_right is None:
                 return None
             prev_cell = new_right
@@ -175,16 +320,20 @@ def find_table_from_index(cells: list[Cell], index: int) -> None | list[int]:
     return table
 
 
-def find_table(cells: list[Cell]) -> None | list[Cell]:
+# the table find_table picks and how many of its cells have text
+def find_best_table(
+    cells: list[Cell], use_index: bool = True
+) -> None | tuple[list[Cell], int]:
+    cell_index = CellIndex(cells) if use_index else None
     # check if each cell can be the top left corner of a table
     best_table = None
     best_count = None
     for i in range(len(cells)):
-        table = find_table_from_index(cells, i)
+        table = find_table_from_index(cells, i, cell_index)
         if table is not None:
             num_with_text = sum(1 for index in table if len(cells[index].text) > 10)
             if num_with_text == 25:
-                return [cells[index] for index in table]
+                return [cells[index] for index in table], num_with_text
             elif best_count is None or num_with_text > best_count:
                 best_count = num_with_text
                 best_table = table
@@ -192,10 +341,19 @@ def find_table(cells: list[Cell]) -> None | list[Cell]:
         return None
     if best_count is None or best_count < 20:
         return None
-    return [cells[index] for index in best_table]
+    return [cells[index] for index in best_table], best_count
+
+
+def find_table(cells: list[Cell], use_index: bool = True) -> None | list[Cell]:
+    best = find_best_table(cells, use_index)
+    if best is None:
+        return None
+    return best[0]
 
 
 def draw_cells(cells: list[Cell], img_path: str, out_path: str):
+    from PIL import Image, ImageDraw
+
     with Image.open(img_path) as im:
         red = (255, 0, 0, 255)
         draw = ImageDraw.Draw(im)
@@ -211,18 +369,81 @@ def draw_cells(cells: list[Cell], img_path: str, out_path: str):
         im.save(out_path, "PNG")
 
 
-def get_texts(data: dict[str, Any]) -> list[Text]:
+# x_offset and y_offset are where the image the OCR ran on starts in the frame
+def get_texts(
+    data: dict[str, Any], x_offset: float = 0.0, y_offset: float = 0.0
+) -> list[Text]:
     texts = data["rec_texts"]
     boxes = data["rec_boxes"]
 
     if len(texts) != len(boxes):
         raise Exception("Text and box lengths are different!")
 
-    texts = [Text(boxes[i], texts[i]) for i in range(0, len(texts))]
+    texts = [
+        Text(
+            [
+                boxes[i][0] + x_offset,
+                boxes[i][1] + y_offset,
+                boxes[i][2] + x_offset,
+                boxes[i][3] + y_offset,
+            ],
+            texts[i],
+        )
+        for i in range(0, len(texts))
+    ]
     texts.sort(key=lambda t: t.taxi_dist)
     return texts
 
 
+# Margin kept around the candidate tables when cropping for OCR, as a fraction
+# of their size. Cell.contains lets a text stick out of a cell by 5% of the
+# cell, which is 1% of a table.
+OCR_CROP_MARGIN = 0.05
+
+
+# (x_min, y_min, x_max, y_max) around every 5x5 group of cells find_table could
+# pick, before it knows their texts, with a margin and clipped to the image. Any
+# text that can end up in the table is inside it.
+def get_ocr_crop(
+    cell_data: dict[str, Any], pos_tolerance: float, width: int, height: int
+) -> tuple[int, int, int, int] | None:
+    cells = get_sorted_cells(cell_data, pos_tolerance, [], 0)
+    if cells is None:
+        return None
+    cell_index = CellIndex(cells)
+    bounds: list[float] | None = None
+    for i in range(len(cells)):
+        table = find_table_from_index(cells, i, cell_index)
+        if table is None:
+            continue
+        table_cells = [cells[index] for index in table]
+        table_bounds = [
+            min(c.x_min for c in table_cells),
+            min(c.y_min for c in table_cells),
+            max(c.x_max for c in table_cells),
+            max(c.y_max for c in table_cells),
+        ]
+        if bounds is None:
+            bounds = table_bounds
+        else:
+            bounds = [
+                min(bounds[0], table_bounds[0]),
+                min(bounds[1], table_bounds[1]),
+                max(bounds[2], table_bounds[2]),
+                max(bounds[3], table_bounds[3]),
+            ]
+    if bounds is None:
+        return None
+    x_margin = (bounds[2] - bounds[0]) * OCR_CROP_MARGIN
+    y_margin = (bounds[3] - bounds[1]) * OCR_CROP_MARGIN
+    return (
+        max(0, int(bounds[0] - x_margin)),
+        max(0, int(bounds[1] - y_margin)),
+        min(width, int(bounds[2] + x_margin) + 1),
+        min(height, int(bounds[3] + y_margin) + 1),
+    )
+
+
 def get_square_from_cell(cell: Cell) -> Square:
     return Square(
         x_min=float(cell.x_min),
@@ -233,15 +454,107 @@ def get_square_from_cell(cell: Cell) -> Square:
     )
 
 
-def get_best_table_from_image(img_path: str) -> list[Square] | None:
-    ocr_data = run_ocr_model(img_path, "ocrtext.png")
-    texts = get_texts(ocr_data)
-    cell_data = run_table_model(img_path, output_img_path="tempimg.png")
+# What to run OCR on for an image the table model found cell_data in, and
+# where that starts in the image. With crop_ocr on, that's only the part of
+# the image that can hold a table, and None if there's no 5x5 group of cells
+# at all. Most of a stream frame is webcams, chat and game footage, so that's a
+# fraction of the pixels and texts.
+def get_ocr_input(
+    img: str | numpy.ndarray, cell_data: dict[str, Any], crop_ocr: bool
+) -> tuple[str | numpy.ndarray, int, int] | None:
+    if not crop_ocr:
+        return img, 0, 0
+    if isinstance(img, str):
+        img_path = img
+        img = cv2.imread(img_path)
+        if img is None:
+            raise Exception(f"Failed to read image {img_path}")
+    crop = get_ocr_crop(cell_data, 0.2, img.shape[1], img.shape[0])
+    if crop is None:
+        return None
+    x_min, y_min, x_max, y_max = crop
+    return numpy.ascontiguousarray(img[y_min:y_max, x_min:x_max]), x_min, y_min
+
+
+def get_table_with_count(
+    cell_data: dict[str, Any], ocr_data: dict[str, Any], x_offset: int, y_offset: int
+) -> None | tuple[list[Cell], int]:
+    texts = get_texts(ocr_data, x_offset, y_offset)
     cells = get_sorted_cells(cell_data, 0.2, texts, 0.05)
     if cells is None:
         return None
-    table = find_table(cells)
-    if table is not None:
-        draw_cells(table, "ocrtext.png", "celldebug.png")
-        return [get_square_from_cell(cell) for cell in table]
-    return None
+    return find_best_table(cells)
+
+
+# With debug on, writes the OCR output to ocrtext.png, the detected cells to
+# tempimg.png and the chosen table to celldebug.png, all in debug_dir. Matches
+# run in parallel, so each should pass its own directory. With crop_ocr on, the
+# table is drawn on tempimg.png, as ocrtext.png only has the crop.
+def get_best_table(
+    img: str | numpy.ndarray,
+    debug: bool,
+    crop_ocr: bool = False,
+    debug_dir: str = ".",
+) -> list[Square] | None:
+    table_img_path = os.path.join(debug_dir, "tempimg.png")
+    ocr_img_path = os.path.join(debug_dir, "ocrtext.png")
+    cell_data = run_table_model(img, output_img_path=table_img_path if debug else None)
+    ocr_input = get_ocr_input(img, cell_data, crop_ocr)
+    if ocr_input is None:
+        return None
+    ocr_img, x_offset, y_offset = ocr_input
+    ocr_data = run_ocr_model(ocr_img, ocr_img_path if debug else None)
+    best = get_table_with_count(cell_data, ocr_data, x_offset, y_offset)
+    if best is None:
+        return None
+    table = best[0]
+    if debug:
+        draw_cells(
+            table,
+            table_img_path if crop_ocr else ocr_img_path,
+            os.path.join(debug_dir, "celldebug.png"),
+        )
+    return [get_square_from_cell(cell) for cell in table]
+
+
+def get_best_table_from_image(
+    img_path: str, debug: bool = False, debug_dir: str = ".", crop_ocr: bool = False
+) -> list[Square] | None:
+    return get_best_table(img_path, debug, crop_ocr, debug_dir)
+
+
+# frame is a decoded BGR frame, e.g. straight from cv2.VideoCapture.read
+def get_best_table_from_frame(
+    frame: numpy.ndarray,
+    debug: bool = False,
+    debug_dir: str = ".",
+    crop_ocr: bool = False,
+) -> list[Square] | None:
+    return get_best_table(frame, debug, crop_ocr, debug_dir)
+
+
+# Looks for the table in every frame with one batched call to each model and
+# returns the index of the frame whose table has the most cells with text,
+# along with that table. The earliest frame wins ties.
+def get_best_table_from_frames(
+    frames: list[numpy.ndarray], crop_ocr: bool = False
+) -> tuple[int, list[Square]] | None:
+    cell_data = run_table_model_batch(frames)
+    ocr_inputs = [
+        get_ocr_input(frame, data, crop_ocr) for frame, data in zip(frames, cell_data)
+    ]
+    indices = [i for i, ocr_input in enumerate(ocr_inputs) if ocr_input is not None]
+    if len(indices) == 0:
+        return None
+    ocr_data = run_ocr_model_batch([ocr_inputs[i][0] for i in indices])
+    best_index = None
+    best: tuple[list[Cell], int] | None = None
+    for i, data in zip(indices, ocr_data):
+        _, x_offset, y_offset = ocr_inputs[i]
+        table = get_table_with_count(cell_data[i], data, x_offset, y_offset)
+        if table is not None and (best is None or table[1] > best[1]):
+            best_index = i
+            best = table
+    if best_index is None or best is None:
+        return None
+    return best_index, [get_square_from_cell(cell) for cell in best[0]]
@@ -1,32 +1,326 @@
+import argparse
+import contextlib
+import cProfile
 import datetime
+import io
 import os
 import time
+import pstats
 import traceback
+import telemetry
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from match import Match
 from parse_csv import get_all_matches
+from sampling import SamplerMode, SamplingOptions, init_decode_worker
 
 
-all_matches = get_all_matches()
-for i in range(len(all_matches)):
-    try:
-        match = all_matches[i]
-        if os.path.isfile(os.path.join(match.dir, "changelog.txt")):
-            continue
-        print(
-            f"Starting match {match.id} ({i+1} of {len(all_matches)}) at {datetime.datetime.now().time()}"
-        )
-        start_time = time.time()
-        with_video = match.get_match_with_video()
-        final_score_matches, _ = with_video.get_changelog()
-
-        with_video.cap.release()
-        # if there's a problem with the final score, don't delete the video
-        # don't remove videos at all now that youtube is rate-limiting me
-        # if final_score_matches:
-        #     os.remove(with_video.video_filename)
-
-        elapsed_time = time.time() - start_time
-        print(
-            f"Finished {match.id} ({i+1} of {len(all_matches)}) in {elapsed_time / 60} mins"
+class MatchResult:
+    def __init__(
+        self,
+        id: str,
+        final_score_matches: bool | None,
+        error: str | None,
+        elapsed_time: float,
+        log: str,
+        telemetry_record: dict | None = None,
+    ):
+        self.id = id
+        self.final_score_matches = final_score_matches
+        self.error = error
+        self.elapsed_time = elapsed_time
+        self.log = log
+        self.telemetry_record = telemetry_record
+
+
+def process_match(
+    match: Match,
+    options: SamplingOptions,
+    debug: bool,
+    refine_times: bool,
+    record_telemetry: bool = False,
+    table_batch: int = 1,
+    crop_ocr: bool = False,
+) -> MatchResult:
+    # collect everything the match prints so output from parallel workers
+    # doesn't get interleaved
+    log = io.StringIO()
+    final_score_matches = None
+    error = None
+    start_time = time.time()
+    if record_telemetry:
+        telemetry.start(match.id)
+    with contextlib.redirect_stdout(log):
+        try:
+            with_video = match.get_match_with_video(debug, table_batch, crop_ocr)
+            final_score_matches, _ = with_video.get_changelog(options, refine_times)
+
+            with_video.cap.release()
+            # if there's a problem with the final score, don't delete the video
+            # don't remove videos at all now that youtube is rate-limiting me
+            # if final_score_matches:
+            #     os.remove(with_video.video_filename)
+        except Exception:
+            error = traceback.format_exc()
+    return MatchResult(
+        match.id,
+        final_score_matches,
+        error,
+        time.time() - start_time,
+        log.getvalue(),
+        telemetry.finish(),
+    )
+
+
+# Runs one match in this process under cProfile, even if it already has a
+# changelog, and saves the stats next to it. With no worker processes it can
+# also be run under an outside profiler, e.g.
+#   py-spy record -o profile.svg -- python generate_changelogs.py --profile ID
+def profile_match(
+    match: Match,
+    options: SamplingOptions,
+    debug: bool,
+    refine_times: bool,
+    telemetry_filename: str | None,
+    table_batch: int,
+    crop_ocr: bool,
+):
+    profiler = cProfile.Profile()
+    result = profiler.runcall(
+        process_match,
+        match,
+        options,
+        debug,
+        refine_times,
+        telemetry_filename is not None,
+        table_batch,
+        crop_ocr,
+    )
+    print(result.log, end="")
+    if result.error is not None:
+        print(result.error)
+    if telemetry_filename is not None and result.telemetry_record is not None:
+        telemetry.write_record(telemetry_filename, result.telemetry_record)
+    profile_name = os.path.join(match.dir, "profile.prof")
+    profiler.dump_stats(profile_name)
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    print(f"Saved profile to {profile_name}")
+
+
+def replay_match(match: Match) -> MatchResult:
+    log = io.StringIO()
+    final_score_matches = None
+    error = None
+    start_time = time.time()
+    with contextlib.redirect_stdout(log):
+        try:
+            final_score_matches, _ = match.replay_changelog()
+        except Exception:
+            error = traceback.format_exc()
+    return MatchResult(
+        match.id, final_score_matches, error, time.time() - start_time, log.getvalue()
+    )
+
+
+def replay_all():
+    all_matches = get_all_matches()
+    replayable = [
+        match for match in all_matches if os.path.isfile(match.raw_colors_name)
+    ]
+    print(f"Replaying {len(replayable)} of {len(all_matches)} matches")
+    start_time = time.time()
+    results: list[MatchResult] = []
+    for match in replayable:
+        result = replay_match(match)
+        results.append(result)
+        print(result.log, end="")
+        if result.error is not None:
+            print(result.error)
+    print_summary(results, time.time() - start_time)
+
+
+def print_summary(results: list[MatchResult], wall_time: float):
+    failures = [r for r in results if r.error is not None]
+    wrong_scores = [r for r in results if r.final_score_matches is False]
+    print(f"Matches done: {len(results) - len(failures)}")
+    print(f"Failures: {len(failures)}")
+    for result in failures:
+        print(f"    {result.id}")
+    print(f"FINAL_SCORE_WRONG: {len(wrong_scores)}")
+    for result in wrong_scores:
+        print(f"    {result.id}")
+    print("Time per match:")
+    for result in sorted(results, key=lambda r: r.elapsed_time, reverse=True):
+        print(f"    {result.id}: {result.elapsed_time / 60:.1f} mins")
+    print(f"Total wall time: {wall_time / 60:.1f} mins")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sampler",
+        type=SamplerMode,
+        choices=list(SamplerMode),
+        default=SamplerMode.SEEK,
+        help="how to move through the video between samples",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of matches to process in parallel, default the number of "
+        "CPUs divided by --shards",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="number of processes to split each match's video between",
+    )
+    parser.add_argument(
+        "--max-stride",
+        type=int,
+        default=1,
+        help="let the 5s stride grow up to this many samples while the board "
+        "doesn't change",
+    )
+    parser.add_argument(
+        "--refine-times",
+        action="store_true",
+        help="bisect between samples to find the exact frame of each change",
+    )
+    parser.add_argument(
+        "--save-raw-colors",
+        action="store_true",
+        help="save the cell means of every sample to raw_colors.npy",
+    )
+    parser.add_argument(
+        "--diff-threshold",
+        type=float,
+        default=None,
+        help="reuse the last sample's colors while no cell's thumbnail mean "
+        "moves by this much, e.g. 8",
+    )
+    parser.add_argument(
+        "--ffmpeg-scale",
+        type=float,
+        default=1.0,
+        help="with --sampler ffmpeg, scale the cropped table by this much",
+    )
+    parser.add_argument(
+        "--pipeline-size",
+        type=int,
+        default=0,
+        help="decode on a separate thread, queueing up to this many frames",
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="rebuild every changelog from raw_colors.npy instead of the video",
+    )
+    parser.add_argument(
+        "--telemetry",
+        default=None,
+        metavar="FILE",
+        help="append per-stage timers and counters for each match to FILE as "
+        "JSON lines",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="ID",
+        help="run only this match, in this process under cProfile",
+    )
+    parser.add_argument(
+        "--table-batch",
+        type=int,
+        default=1,
+        help="run the table models on this many candidate frames at once and "
+        "keep the table with the most cells with text",
+    )
+    parser.add_argument(
+        "--crop-ocr",
+        action="store_true",
+        help="run OCR only on the part of the frame the table models found a "
+        "table in",
+    )
+    parser.add_argument(
+        "--debug-images",
+        action="store_true",
+        help="write the intermediate images from table detection",
+    )
+    args = parser.parse_args()
+    if args.workers is None:
+        # every worker starts --shards processes of its own
+        args.workers = max(1, (os.cpu_count() or 1) // args.shards)
+    if args.replay:
+        replay_all()
+        return
+    options = SamplingOptions(
+        mode=args.sampler,
+        shards=args.shards,
+        max_stride=args.max_stride,
+        save_raw_colors=args.save_raw_colors,
+        diff_threshold=args.diff_threshold,
+        ffmpeg_scale=args.ffmpeg_scale,
+        pipeline_size=args.pipeline_size,
+    )
+
+    all_matches = get_all_matches()
+    if args.profile is not None:
+        match = next((m for m in all_matches if m.id == args.profile), None)
+        if match is None:
+            raise Exception(f"No match with id {args.profile}")
+        profile_match(
+            match,
+            options,
+            args.debug_images,
+            args.refine_times,
+            args.telemetry,
+            args.table_batch,
+            args.crop_ocr,
         )
-    except Exception as error:
-        print(traceback.format_exc())
+        return
+    pending = [
+        match
+        for match in all_matches
+        if not os.path.isfile(os.path.join(match.dir, "changelog.txt"))
+    ]
+    print(
+        f"Starting {len(pending)} of {len(all_matches)} matches with "
+        f"{args.workers} workers at {datetime.datetime.now().time()}"
+    )
+    start_time = time.time()
+    results: list[MatchResult] = []
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_decode_worker
+    ) as executor:
+        futures = [
+            executor.submit(
+                process_match,
+                match,
+                options,
+                args.debug_images,
+                args.refine_times,
+                args.telemetry is not None,
+                args.table_batch,
+                args.crop_ocr,
+            )
+            for match in pending
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(
+                f"Finished {result.id} ({len(results)} of {len(pending)}) "
+                f"in {result.elapsed_time / 60} mins"
+            )
+            print(result.log, end="")
+            if result.error is not None:
+                print(result.error)
+            if args.telemetry is not None and result.telemetry_record is not None:
+                telemetry.write_record(args.telemetry, result.telemetry_record)
+    print_summary(results, time.time() - start_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,20 @@
+import argparse
 import csv
+import hashlib
 import json
 import os
-from changelog import deserialize_changelog_file
+import time
+from changelog import Change, deserialize_changelog
 from color import Color
 from make_url import get_url_at_time
-from match import GoalCompletion
+from match import GoalCompletion, Match
 from parse_csv import get_all_matches
-from square import deserialize_board_file
-from text_correction import get_confirmed_text
+from square import Square, deserialize_board
+from text_correction import corrections, get_confirmed_text, goals_list
 from datetime import datetime
+from typing import Any
 from zoneinfo import ZoneInfo
 
-
 old_week_to_new_week = {
     "1": "Week 1",
     "2": "Week 2",
@@ -77,10 +80,9 @@ def get_csv_row(gc: GoalCompletion) -> list[str]:
     ]
 
 
-matches = get_all_matches()
-all_games = get_all_games()
-final = []
-for match in matches:
+def get_migration_entry(
+    match: Match, changelog: list[Change], table: list[Square]
+) -> dict[str, Any]:
     unixtime = get_unixtime(match.date, match.timestr)
     #     {
     #   "reveals": [
@@ -102,11 +104,6 @@ for match in matches:
     #     },
     match_start_time = unixtime + 30
 
-    changelog_name = os.path.join(match.dir, "changelog.txt")
-    if not os.path.isfile(changelog_name):
-        print(f"No changelog found for ID {match.id}")
-        continue
-    changelog = deserialize_changelog_file(changelog_name)
     final_stats = GoalCompletion.get_final_stats(changelog, match.id)
     if final_stats is None:
         raise Exception("failed to get final stats")
@@ -148,7 +145,6 @@ for match in matches:
     ]
 
     changelog_for_json = {"reveals": reveals, "changes": changes_for_json}
-    table = deserialize_board_file(os.path.join(match.dir, "table.json"))
 
     final_board_from_changes = GoalCompletion.get_final_board_from_changelog(changelog)
 
@@ -167,23 +163,147 @@ for match in matches:
     board_json = json.dumps(board_for_json, separators=(",", ":"))
     changelog_json = json.dumps(changelog_for_json, separators=(",", ":"))
 
-    final.append(
-        {
-            "board_json": board_json,
-            "changelog_json": changelog_json,
-            "date_created": unixtime,
-            "id": f"S1__{match.id}",
-            "name": f"{match.p1_name} vs {match.p2_name}",
-            "week": old_week_to_new_week[match.week],
-            "tier": match.tier,
-            "p1": match.p1_name,
-            "p2": match.p2_name,
-            "vod_url": match.vod,
-            "vod_match_start_seconds": int(match.start),
+    return {
+        "board_json": board_json,
+        "changelog_json": changelog_json,
+        "date_created": unixtime,
+        "id": f"S1__{match.id}",
+        "name": f"{match.p1_name} vs {match.p2_name}",
+        "week": old_week_to_new_week[match.week],
+        "tier": match.tier,
+        "p1": match.p1_name,
+        "p2": match.p2_name,
+        "vod_url": match.vod,
+        "vod_match_start_seconds": int(match.start),
+    }
+
+
+# Each match's entry is cached along with a hash of everything that went into
+# it, so a rerun only rebuilds the matches whose changelog, table, CSV row,
+# corrections, goal list or game list changed.
+MIGRATION_CACHE_NAME = "migration_cache.json"
+# Bump this whenever what an entry comes out as changes without any of those
+# inputs changing: get_migration_entry, get_unixtime,
+# GoalCompletion.get_final_stats and get_final_board_from_changelog,
+# get_confirmed_text, deserialize_changelog and deserialize_board, or the
+# fields stored in the cache.
+MIGRATION_CACHE_VERSION = 1
+
+goals_digest = hashlib.sha256("\n".join(goals_list).encode()).hexdigest()
+games_digest = hashlib.sha256("\n".join(all_games).encode()).hexdigest()
+
+
+def load_migration_cache() -> dict[str, dict[str, Any]]:
+    if not os.path.isfile(MIGRATION_CACHE_NAME):
+        return {}
+    with open(MIGRATION_CACHE_NAME, "r") as f:
+        cache = json.load(f)
+    if cache["version"] != MIGRATION_CACHE_VERSION:
+        return {}
+    return cache["matches"]
+
+
+def save_migration_cache(matches: dict[str, dict[str, Any]]):
+    with open(MIGRATION_CACHE_NAME, "w") as f:
+        json.dump({"version": MIGRATION_CACHE_VERSION, "matches": matches}, f)
+
+
+# texts are the table's goal texts, which decide which corrections are used.
+# For a cached entry they come from the cache, which is fine: if the table
+# changed since, its bytes change the key anyway.
+def get_cache_key(
+    match: Match, changelog_bytes: bytes, table_bytes: bytes, texts: list[str]
+) -> str:
+    key = hashlib.sha256()
+    for part in [
+        str(MIGRATION_CACHE_VERSION).encode(),
+        json.dumps(match.row).encode(),
+        goals_digest.encode(),
+        games_digest.encode(),
+        json.dumps([corrections.get(text) for text in texts]).encode(),
+        changelog_bytes,
+        table_bytes,
+    ]:
+        key.update(hashlib.sha256(part).digest())
+    return key.hexdigest()
+
+
+def read_bytes(filename: str) -> bytes:
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+# streams the pre-rendered entries out without building the whole document.
+# The pretty layout is byte for byte what json.dumps(entries, indent=2) gives.
+def write_migration(fragments: list[str], filename: str, compact: bool):
+    with open(filename, "w") as f:
+        if compact:
+            f.write("[")
+            f.write(",".join(fragments))
+            f.write("]")
+        elif len(fragments) == 0:
+            f.write("[]")
+        else:
+            f.write("[\n")
+            f.write(",\n".join(fragments))
+            f.write("\n]")
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--compact",
+    action="store_true",
+    help="write migration.json without indentation",
+)
+parser.add_argument(
+    "--rebuild",
+    action="store_true",
+    help="ignore the cache and rebuild every match",
+)
+args = parser.parse_args()
+
+start_time = time.perf_counter()
+matches = get_all_matches()
+all_games = get_all_games()
+cache = {} if args.rebuild else load_migration_cache()
+new_cache: dict[str, dict[str, Any]] = {}
+fragments: list[str] = []
+num_rebuilt = 0
+for match in matches:
+    changelog_name = os.path.join(match.dir, "changelog.txt")
+    if not os.path.isfile(changelog_name):
+        print(f"No changelog found for ID {match.id}")
+        continue
+    changelog_bytes = read_bytes(changelog_name)
+    table_bytes = read_bytes(os.path.join(match.dir, "table.json"))
+
+    cached = cache.get(match.id)
+    if cached is None or cached["key"] != get_cache_key(
+        match, changelog_bytes, table_bytes, cached["texts"]
+    ):
+        changelog = deserialize_changelog(changelog_bytes.decode())
+        table = deserialize_board(table_bytes.decode())
+        entry = get_migration_entry(match, changelog, table)
+        texts = [square.text for square in table]
+        pretty = json.dumps(entry, indent=2)
+        cached = {
+            "key": get_cache_key(match, changelog_bytes, table_bytes, texts),
+            "texts": texts,
+            # indented to sit inside the top level list
+            "pretty": "\n".join("  " + line for line in pretty.splitlines()),
+            "compact": json.dumps(entry, separators=(",", ":")),
         }
-    )
-with open("migration.json", "w") as f:
-    f.write(json.dumps(final, indent=2))
+        num_rebuilt += 1
+    new_cache[match.id] = cached
+    fragments.append(cached["compact" if args.compact else "pretty"])
+
+write_migration(fragments, "migration.json", args.compact)
+if num_rebuilt > 0 or new_cache.keys() != cache.keys():
+    save_migration_cache(new_cache)
+print(
+    f"Rebuilt {num_rebuilt} of {len(fragments)} matches in "
+    f"{1000 * (time.perf_counter() - start_time):.0f} ms"
+)
 
 # with open("goal_completions.csv", "w", encoding="utf8", newline="") as f:
 #     writer = csv.writer(f)
@@ -0,0 +1,212 @@
+import cv2
+import numpy
+
+import telemetry
+
+# A cheap check for whether a frame shows a bingo board, so the table and OCR
+# models only run on frames that are likely to have one. The board is a 5x5
+# grid of cells with text in them, so a frame is scored by how well a 5x5
+# lattice fits the places where long horizontal and vertical edges cross, and
+# how many of its cells have text-like edges inside.
+#
+# Stream layouts have other grids, like checkerboard backgrounds and the UFO 50
+# game select screen. Their cells are empty or their lattice keeps going past
+# 5x5, so lattice points just outside the 5x5 count against it.
+
+# frames are scaled to this width first
+GRID_WIDTH = 960
+# brightness difference between neighbouring pixels that counts as an edge
+EDGE_THRESHOLD = 12
+# shortest run of edge pixels that counts as a grid line, at GRID_WIDTH
+MIN_LINE_LENGTH = 24
+# range of cell sizes looked for, at GRID_WIDTH
+MIN_PITCH = 20
+MAX_PITCH = 200
+# how far a crossing can be from a lattice point and still count as on it
+LATTICE_TOLERANCE = 4
+# fraction of a cell's middle that has to be edges for it to count as text
+MIN_TEXT_DENSITY = 0.04
+# lattice points on the ring just outside the 5x5 that make the score 0
+MAX_RING_HITS = 12
+
+# lattice indices around the crossing a lattice is fitted from. A 5x5 grid has
+# 6 lines each way, so -5..5 covers every position of the crossing in it, and
+# -6 and 6 are the ring around it.
+LATTICE_STEPS = numpy.arange(-6, 7)
+# the middle of a cell, as a fraction of the cell size
+CELL_INSET = numpy.array([0.2, 0.8])
+
+
+class GridScore:
+    def __init__(
+        self,
+        score: float = 0.0,
+        bounds: tuple[float, float, float, float] | None = None,
+    ):
+        # 0 to 1, 1 being a full grid with text in every cell and nothing around
+        self.score = score
+        # (x_min, y_min, x_max, y_max) of the grid in frame pixels
+        self.bounds = bounds
+
+
+# sums of every size x size window of a 2d array, from its integral image
+def get_window_sums(integral: numpy.ndarray, size: int, start: int, count: int):
+    low = slice(start, start + count)
+    high = slice(start + size, start + size + count)
+    return (
+        integral[high, high]
+        - integral[low, high]
+        - integral[high, low]
+        + integral[low, low]
+    )
+
+
+def get_edges(gray: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    # vertical edges are between horizontal neighbours and the other way around
+    vertical = cv2.absdiff(gray[:-1, 1:], gray[:-1, :-1]) > EDGE_THRESHOLD
+    horizontal = cv2.absdiff(gray[1:, :-1], gray[:-1, :-1]) > EDGE_THRESHOLD
+    return vertical.view(numpy.uint8), horizontal.view(numpy.uint8)
+
+
+# centers of the places where a long vertical and a long horizontal edge meet
+def get_crossings(vertical: numpy.ndarray, horizontal: numpy.ndarray) -> numpy.ndarray:
+    vertical_lines = cv2.morphologyEx(
+        vertical,
+        cv2.MORPH_OPEN,
+        cv2.getStructuringElement(cv2.MORPH_RECT, (1, MIN_LINE_LENGTH)),
+    )
+    horizontal_lines = cv2.morphologyEx(
+        horizontal,
+        cv2.MORPH_OPEN,
+        cv2.getStructuringElement(cv2.MORPH_RECT, (MIN_LINE_LENGTH, 1)),
+    )
+    # lines between cells are a few pixels wide, so their edges don't touch
+    kernel = numpy.ones((5, 5), numpy.uint8)
+    crossings = cv2.dilate(vertical_lines, kernel) & cv2.dilate(
+        horizontal_lines, kernel
+    )
+    _, _, _, centroids = cv2.connectedComponentsWithStats(crossings)
+    # the first component is the background
+    return centroids[1:]
+
+
+# Fits a lattice to the crossings, with its spacing taken from the crossing's
+# nearest neighbours to the right and below, and scores every 5x5 window of it
+# that has the crossing in it.
+def score_lattice(
+    crossings: numpy.ndarray,
+    anchor: numpy.ndarray,
+    edge_integral: numpy.ndarray,
+) -> GridScore:
+    height = edge_integral.shape[0] - 1
+    width = edge_integral.shape[1] - 1
+    x, y = anchor
+    dx = crossings[:, 0] - x
+    dy = crossings[:, 1] - y
+    right = (abs(dy) < LATTICE_TOLERANCE) & (dx >= MIN_PITCH) & (dx <= MAX_PITCH)
+    below = (abs(dx) < LATTICE_TOLERANCE) & (dy >= MIN_PITCH) & (dy <= MAX_PITCH)
+    if not right.any() or not below.any():
+        return GridScore()
+    pitch_x = dx[right].min()
+    pitch_y = dy[below].min()
+
+    # which lattice points have a crossing on them
+    steps_x = numpy.round(dx / pitch_x)
+    steps_y = numpy.round(dy / pitch_y)
+    on_lattice = (
+        (abs(dx - steps_x * pitch_x) < LATTICE_TOLERANCE)
+        & (abs(dy - steps_y * pitch_y) < LATTICE_TOLERANCE)
+        & (abs(steps_x) <= 6)
+        & (abs(steps_y) <= 6)
+    )
+    size = len(LATTICE_STEPS)
+    hits = numpy.zeros((size, size), numpy.uint8)
+    hits[
+        (steps_y[on_lattice] + 6).astype(int), (steps_x[on_lattice] + 6).astype(int)
+    ] = 1
+    lines_x = x + LATTICE_STEPS * pitch_x
+    lines_y = y + LATTICE_STEPS * pitch_y
+    # a board can be cut off by the edge of the frame, so its last line can't
+    # be seen. Lattice points on the edge count as hits, but not for the ring.
+    on_edge = hits.copy()
+    on_edge[
+        (abs(lines_y) < LATTICE_TOLERANCE)
+        | (abs(lines_y - height) < LATTICE_TOLERANCE),
+        :,
+    ] = 1
+    on_edge[
+        :,
+        (abs(lines_x) < LATTICE_TOLERANCE) | (abs(lines_x - width) < LATTICE_TOLERANCE),
+    ] = 1
+
+    # the 6x6 points of the windows, starting at lattice steps -5..0
+    window_hits = get_window_sums(cv2.integral(on_edge), 6, 1, 6)
+    hits_integral = cv2.integral(hits)
+    ring_hits = get_window_sums(hits_integral, 8, 0, 6) - get_window_sums(
+        hits_integral, 6, 1, 6
+    )
+    # windows that go past the edge of the frame
+    inside_x = (lines_x[1:7] > -LATTICE_TOLERANCE) & (
+        lines_x[6:12] < width + LATTICE_TOLERANCE
+    )
+    inside_y = (lines_y[1:7] > -LATTICE_TOLERANCE) & (
+        lines_y[6:12] < height + LATTICE_TOLERANCE
+    )
+
+    # edge density in the middle of each of the 10x10 cells between steps -5..5
+    cell_x = numpy.clip(
+        numpy.round(lines_x[1:11, None] + CELL_INSET * pitch_x).astype(int), 0, width
+    )
+    cell_y = numpy.clip(
+        numpy.round(lines_y[1:11, None] + CELL_INSET * pitch_y).astype(int), 0, height
+    )
+    x_min, x_max = cell_x[None, :, 0], cell_x[None, :, 1]
+    y_min, y_max = cell_y[:, None, 0], cell_y[:, None, 1]
+    area = (x_max - x_min) * (y_max - y_min)
+    edge_count = (
+        edge_integral[y_max, x_max]
+        - edge_integral[y_min, x_max]
+        - edge_integral[y_max, x_min]
+        + edge_integral[y_min, x_min]
+    )
+    has_text = (area > 0) & (edge_count >= MIN_TEXT_DENSITY * area)
+    window_text = get_window_sums(cv2.integral(has_text.view(numpy.uint8)), 5, 0, 6)
+
+    scores = (
+        window_hits
+        * window_text
+        * numpy.maximum(MAX_RING_HITS - ring_hits, 0)
+        * (inside_y[:, None] & inside_x[None, :])
+    )
+    row, col = numpy.unravel_index(numpy.argmax(scores), scores.shape)
+    return GridScore(
+        float(scores[row, col]) / (36 * 25 * MAX_RING_HITS),
+        (
+            float(lines_x[col + 1]),
+            float(lines_y[row + 1]),
+            float(lines_x[col + 6]),
+            float(lines_y[row + 6]),
+        ),
+    )
+
+
+def get_grid_score(frame: cv2.typing.MatLike) -> GridScore:
+    with telemetry.stage("grid_score"):
+        scale = GRID_WIDTH / frame.shape[1]
+        small = cv2.resize(
+            frame,
+            (GRID_WIDTH, round(frame.shape[0] * scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+        vertical, horizontal = get_edges(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+        crossings = get_crossings(vertical, horizontal)
+        edge_integral = cv2.integral(vertical | horizontal)
+        best = GridScore()
+        for anchor in crossings:
+            grid_score = score_lattice(crossings, anchor, edge_integral)
+            if grid_score.score > best.score:
+                best = grid_score
+        if best.bounds is not None:
+            x_min, y_min, x_max, y_max = best.bounds
+            best.bounds = (x_min / scale, y_min / scale, x_max / scale, y_max / scale)
+        return best
@@ -2,14 +2,22 @@ import json
 import math
 import os
 import subprocess
-import cv2
 
+import telemetry
+from board import Board
 from changelog import Change, serialize_changelog_to_file
-from find_table import get_best_table_from_image
-from square import Square, deserialize_board_file, serialize_board_to_file
+from square import Square
 from color import Color
-from video import get_named_colors
 from collections import Counter
+from typing import TYPE_CHECKING
+
+# Match and GoalCompletion only need the CSV, changelogs and tables, so
+# anything that touches video (numpy, cv2, the reference swatches, PaddleOCR)
+# is imported when it's first used. That keeps the reporting scripts fast to
+# start.
+if TYPE_CHECKING:
+    import numpy
+    from match_with_video import MatchWithVideo
 
 
 class GoalCompletion:
@@ -57,21 +65,22 @@ class GoalCompletion:
 
     @staticmethod
     def print_board_state(
-        board: list[Color],
+        board: Board | list[Color],
     ):
+        colors = list(board)
         for i in range(0, 5):
-            row = board[5 * i : 5 * i + 5]
+            row = colors[5 * i : 5 * i + 5]
             # 6 is max length. Add 4 extra spaces for gaps
             print("".join([color.value.ljust(10) for color in row]))
 
     @staticmethod
     def get_final_board_from_changelog(
         changelog: list[Change],
-    ) -> list[Color]:
-        final_board = [Color.BLACK for _ in range(0, 25)]
+    ) -> Board:
+        final_colors = [Color.BLACK for _ in range(0, 25)]
         for c in changelog:
-            final_board[c.square_index] = c.color
-        return final_board
+            final_colors[c.square_index] = c.color
+        return Board.from_colors(final_colors)
 
     # (winner color, winner score, has bingo, loser color, loser score)
     @staticmethod
@@ -82,43 +91,11 @@ class GoalCompletion:
         if id == "7__may__Marshmallow":
             return (Color.BLUE, 11, False, Color.BROWN, 12)
         final_board = GoalCompletion.get_final_board_from_changelog(changelog)
-        bingo_lines = [
-            # rows
-            [0, 1, 2, 3, 4],
-            [5, 6, 7, 8, 9],
-            [10, 11, 12, 13, 14],
-            [15, 16, 17, 18, 19],
-            [20, 21, 22, 23, 24],
-            # columns
-            [0, 5, 10, 15, 20],
-            [1, 6, 11, 16, 21],
-            [2, 7, 12, 17, 22],
-            [3, 8, 13, 18, 23],
-            [4, 9, 14, 19, 24],
-            # diagonals
-            [0, 6, 12, 18, 24],
-            [4, 8, 12, 16, 20],
-        ]
-        bingo_first_square = next(
-            (
-                line[0]
-                for line in bingo_lines
-                if final_board[line[0]] != Color.BLACK
-                and (
-                    final_board[line[0]]
-                    == final_board[line[1]]
-                    == final_board[line[2]]
-                    == final_board[line[3]]
-                    == final_board[line[4]]
-                )
-            ),
-            None,
-        )
+        bingo_first_square = final_board.get_bingo_first_square()
         bingo_winner = None
         if bingo_first_square is not None:
             bingo_winner = final_board[bingo_first_square]
-        square_count = Counter(c for c in final_board if c != Color.BLACK)
-        most_common = square_count.most_common()
+        most_common = final_board.get_scores()
 
         if len(most_common) > 2:
             return None
@@ -248,6 +225,7 @@ class Match:
     def __init__(
         self,
         row: list[str],
+        output_root: str = "output",
     ):
         self.week = row[0]
         self.tier = row[1]
@@ -267,169 +245,87 @@ class Match:
             " ", "_"
         )
         self.timestr = row[13]
+        self.row = row
 
-        self.dir = os.path.join("output", self.id)
+        # everything for the match goes under output_root/<id>. Only the
+        # benchmark puts matches anywhere other than output/
+        self.output_root = output_root
+        self.dir = os.path.join(output_root, self.id)
+        self.raw_colors_name = os.path.join(self.dir, "raw_colors.npy")
 
-        if not os.path.isdir("output"):
-            os.mkdir("output")
+        if not os.path.isdir(output_root):
+            os.mkdir(output_root)
         if not os.path.isdir(self.dir):
             os.mkdir(self.dir)
 
-    def get_match_with_video(self) -> "MatchWithVideo":
-        # we don't know what the video file extension is
-        for fname in os.listdir(self.dir):
-            if (
-                fname.startswith("video")
-                and not fname.endswith(".part")
-                and not fname.endswith(".ytdl")
-                and fname.count(".") == 1
-            ):
-                return MatchWithVideo(self, os.path.join(self.dir, fname))
-        # temporary while youtube is being stupid
-        raise Exception("No video downloading allowed now")
-
-        print(f"Downloading video for {self.id}")
-        cmd = [
-            "yt-dlp",
-            "--quiet",
-            "--no-warnings",
-            "--get-filename",
-            "--no-simulate",
-            "--output",
-            os.path.join(self.dir, "video.%(ext)s"),
-            self.vod,
-        ]
-        fname = subprocess.getoutput(cmd)
-        print(f"Done downloading video for id {self.id}")
-        return MatchWithVideo(self, fname)
-
-
-class MatchWithVideo(Match):
-    def __init__(self, match: Match, video_filename: str):
-        self.__dict__.update(match.__dict__)
-        self.video_filename = video_filename
-
-        self.cap = cv2.VideoCapture(video_filename)
-        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
-        self.frame_name = os.path.join(self.dir, "frame.png")
-
-        self.table = self.get_table()
-
-    def move_to_sec(self, sec: float):
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.fps * sec)
-
-    def get_table(self) -> list[Square]:
-        table_json_name = os.path.join(self.dir, "table.json")
-        if os.path.isfile(table_json_name):
-            return deserialize_board_file(table_json_name)
-
-        # Unfortunately the best video quality for this is 360p.
-        if self.id == "2__Marshmallow__CodeMeRight1":
-            raise Exception(
-                "Video quality too poor for OCR. Create table.json manually"
-            )
-
-        height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        # for some reason yt-dlp will sometimes download a low quality video even
-        # when a higher quality video is available. In that case just throw
-        # an exception and we'll retry later
-        if height < 700:
-            self.cap.release()
-            os.remove(self.video_filename)
-            raise Exception("Video quality too poor for OCR. Try again")
-        print(f"Starting to OCR for id {self.id}")
-        time = self.board_start
-        max_time = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.fps
-
-        override_path = os.path.join(self.dir, "ocr_override_frame.png")
-        if os.path.isfile(override_path):
-            table = get_best_table_from_image(override_path)
-
-            if table is None:
-                raise Exception(
-                    f"Failed to find table in override frame for id {self.id}"
-                )
-
-            print(f"Done OCRing table for id {self.id}")
-
-            serialize_board_to_file(table, table_json_name)
-            return table
-
-        while time <= max_time:
-            self.move_to_sec(time)
-            ret, frame = self.cap.read()
-            if not ret:
-                raise Exception(f"Failed to read video for ID: {self.id}")
-
-            # manual frame in case background is too noisy
-            # only relevant for mordaak vs stnfwds
-            # frame = cv2.imread("manual_frame.png")
-            # frame = cv2.imread("maual_frame_glove_redrobot.png")
-
-            cv2.imwrite(self.frame_name, frame)
-            table = get_best_table_from_image(self.frame_name)
-
-            if table is None:
-                print(f"Failed to find table at time {time} for id {self.id}")
-                time += 120
-                continue
-
-            print(f"Done OCRing table for id {self.id}")
-
-            serialize_board_to_file(table, table_json_name)
-            return table
-        raise Exception(f"Failed to find table at ANY time for id {self.id}")
-
-    def get_colors(
+    def correct_color(self, square_index: int, color: Color) -> Color:
+        # Manual correction. Flesh accidentally marked this as Red instead of Purple
+        if (
+            self.id == "2__boardsofhannahda__Flesh177"
+            and square_index == 3
+            and color == Color.RED
+        ):
+            return Color.PURPLE
+        return color
+
+    def classify_means(
         self,
-        frame: cv2.typing.MatLike,
-        color_restrictions: None | set[Color],
+        means: "numpy.ndarray",
+        color_mask: "numpy.ndarray",
         time: float,
     ) -> None | list[Color]:
-        colors = get_named_colors(self.table, frame, color_restrictions)
-        # Manual correction. Flesh accidentally marked this as Red instead of Purple
-        if self.id == "2__boardsofhannahda__Flesh177" and colors[3] == Color.RED:
-            colors[3] = Color.PURPLE
+        from video import get_reference_palette
+
+        colors = get_reference_palette().classify(means, color_mask)
+        colors[3] = self.correct_color(3, colors[3])
         counter = Counter([c for c in colors])
         # this can happen if there are stream effects like sub notifications
         # that render on top of the table
         if len(counter) > 3:
             print(f"Found more than 3 colors at time {time}: {counter}")
+            telemetry.count("occlusion_rejects")
             return None
         return colors
 
-    # return value is
-    # (first_done_time, [time, list of colors])
-    # we include first_done_time because it's possible we can get to a state
-    # where we've already detected a finished state, but the game isn't actually over
-    # due to squares being unmarked by refs
-    def get_distinct_states(
-        self,
-    ) -> list[tuple[float, list[Color]]]:
-        print(f"Starting to get distinct states for id {self.id}")
+    def get_color_mask(self) -> "numpy.ndarray":
+        from video import get_reference_palette
+
         color_restrictions = None
         color_restrictions_name = os.path.join(self.dir, "color_restrictions.json")
         if os.path.isfile(color_restrictions_name):
             with open(color_restrictions_name, "r") as file:
                 color_name_arr: list[str] = json.load(file)
                 color_restrictions = {Color(color_str) for color_str in color_name_arr}
+        return get_reference_palette().get_mask(color_restrictions)
+
+    # Appends a sample unless it repeats the run of samples before it. Only the
+    # first and last sample of a run are kept. Repeats never change the result
+    # of get_states_from_samples, and the last one is when the state before a
+    # change was last seen, which MatchWithVideo.refine_change_times bisects
+    # from.
+    @staticmethod
+    def add_sample(
+        samples: list[tuple[float, list[Color]]], time: float, colors: list[Color]
+    ):
+        if len(samples) > 1 and samples[-1][1] == colors and samples[-2][1] == colors:
+            samples[-1] = (time, colors)
+        else:
+            samples.append((time, colors))
 
+    # return value is
+    # (first_done_time, [time, list of colors])
+    # we include first_done_time because it's possible we can get to a state
+    # where we've already detected a finished state, but the game isn't actually over
+    # due to squares being unmarked by refs
+    @staticmethod
+    def get_states_from_samples(
+        samples: list[tuple[float, list[Color]]],
+    ) -> list[tuple[float, list[Color]]]:
+        # the samples and states stay lists. Building a Board for each one
+        # costs more than the cheaper diffs save.
         states: list[tuple[float, list[Color]]] = []
         recent_colors = None
-        time = self.board_start
-        max_time = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.fps
-        frame = None
-        while time <= max_time:
-            self.move_to_sec(time)
-            has_frame, frame = self.cap.read()
-            if not has_frame:
-                time += 5
-                continue
-            # cv2.imwrite(self.frame_name, frame)
-            colors = self.get_colors(frame, color_restrictions, time)
-            if colors is None:
-                time += 5
-                continue
+        for time, colors in samples:
             # GoalCompletion.print_distinct_states([(time, colors)])
             if recent_colors != colors:
                 num_changes = 0
@@ -442,13 +338,12 @@ class MatchWithVideo(Match):
                 if num_changes < 5:
                     states.append((time, colors))
                     recent_colors = colors
-            time += 5
-        if frame is not None:
-            cv2.imwrite(self.frame_name, frame)
         return states
 
-    def get_changelog(self) -> tuple[bool, list[Change]]:
-        states = self.get_distinct_states()
+    @staticmethod
+    def get_changelog_from_states(
+        states: list[tuple[float, list[Color]]],
+    ) -> list[Change]:
         changelog: list[Change] = []
         # pickle_name = os.path.join(self.dir, "states.pickle")
         # with open(pickle_name, "wb") as file:
@@ -461,13 +356,19 @@ class MatchWithVideo(Match):
                     changelog.append(
                         Change(time=states[i][0], square_index=j, color=new_colors[j])
                     )
+        return changelog
 
+    def write_changelog(self, changelog: list[Change]) -> bool:
         changelog_filename = os.path.join(self.dir, "changelog.txt")
         serialize_changelog_to_file(changelog, changelog_filename)
         final_stats = GoalCompletion.get_final_stats(changelog, self.id)
         wrong_end_state = final_stats is None or not GoalCompletion.verify_stats(
             final_stats, self
         )
+        # a replay can fix a match, so don't leave flags from an earlier run
+        for flag_name in ["FINAL_SCORE_WRONG.txt", "BAD_COLORS.txt"]:
+            if os.path.isfile(os.path.join(self.dir, flag_name)):
+                os.remove(os.path.join(self.dir, flag_name))
         if wrong_end_state:
             with open(os.path.join(self.dir, "FINAL_SCORE_WRONG.txt"), "w") as file:
                 file.write(f"Actual stats: {final_stats}\n")
@@ -483,4 +384,92 @@ class MatchWithVideo(Match):
         if len(all_colors) != 2:
             with open(os.path.join(self.dir, "BAD_COLORS.txt"), "w") as file:
                 file.write(f"Found colors {all_colors}\n")
-        return not wrong_end_state, changelog
+        return not wrong_end_state
+
+    # raw_colors.npy has one row per sample: the time, then the 25x3 BGR cell
+    # means flattened in square order. It's float64 rather than float32 so
+    # replaying classifies exactly the means the original run did. A 2 hour
+    # match is about 1 MB.
+    def save_raw_colors(self, raw_colors: list[tuple[float, "numpy.ndarray"]]):
+        import numpy
+
+        # adaptive sampling can read a sample more than once while backtracking
+        by_time = dict(raw_colors)
+        rows = [
+            numpy.concatenate(([time], by_time[time].ravel()))
+            for time in sorted(by_time)
+        ]
+        numpy.save(self.raw_colors_name, numpy.array(rows).reshape(-1, 76))
+
+    def load_raw_colors(self) -> list[tuple[float, "numpy.ndarray"]]:
+        import numpy
+
+        data = numpy.load(self.raw_colors_name)
+        return [(float(row[0]), row[1:].reshape(25, 3)) for row in data]
+
+    # same filtering as MatchWithVideo.sample_colors
+    def classify_raw_colors(
+        self,
+        raw_colors: list[tuple[float, "numpy.ndarray"]],
+        color_mask: "numpy.ndarray",
+    ) -> list[tuple[float, list[Color]]]:
+        samples: list[tuple[float, list[Color]]] = []
+        for time, means in raw_colors:
+            colors = self.classify_means(means, color_mask, time)
+            if colors is None:
+                continue
+            Match.add_sample(samples, time, colors)
+        return samples
+
+    # Rebuilds the states and changelog from raw_colors.npy without opening
+    # the video, so changes to the swatches, color restrictions or filtering
+    # rules can be checked against every match in seconds
+    def replay_changelog(self) -> tuple[bool, list[Change]]:
+        samples = self.classify_raw_colors(
+            self.load_raw_colors(), self.get_color_mask()
+        )
+        states = Match.get_states_from_samples(samples)
+        changelog = Match.get_changelog_from_states(states)
+        return self.write_changelog(changelog), changelog
+
+    # the downloaded video, or None if there isn't one yet. We don't know what
+    # the video file extension is
+    def get_video_filename(self) -> str | None:
+        for fname in os.listdir(self.dir):
+            if (
+                fname.startswith("video")
+                and not fname.endswith(".part")
+                and not fname.endswith(".ytdl")
+                and fname.count(".") == 1
+            ):
+                return os.path.join(self.dir, fname)
+        return None
+
+    # with debug on, table detection writes its intermediate images to disk.
+    # table_batch is how many candidate frames the table models run on at once,
+    # and with crop_ocr on OCR only runs on the part that can hold the table
+    def get_match_with_video(
+        self, debug: bool = False, table_batch: int = 1, crop_ocr: bool = False
+    ) -> "MatchWithVideo":
+        from match_with_video import MatchWithVideo
+
+        video_filename = self.get_video_filename()
+        if video_filename is not None:
+            return MatchWithVideo(self, video_filename, debug, table_batch, crop_ocr)
+        # temporary while youtube is being stupid
+        raise Exception("No video downloading allowed now")
+
+        print(f"Downloading video for {self.id}")
+        cmd = [
+            "yt-dlp",
+            "--quiet",
+            "--no-warnings",
+            "--get-filename",
+            "--no-simulate",
+            "--output",
+            os.path.join(self.dir, "video.%(ext)s"),
+            self.vod,
+        ]
+        fname = subprocess.getoutput(cmd)
+        print(f"Done downloading video for id {self.id}")
+        return MatchWithVideo(self, fname, debug, table_batch, crop_ocr)
@@ -0,0 +1,663 @@
+import contextlib
+import io
+import itertools
+import os
+import cv2
+import numpy
+from time import perf_counter
+
+import telemetry
+from changelog import Change
+from match import Match
+from square import Square, deserialize_board_file, serialize_board_to_file
+from color import Color
+from grid_detector import get_grid_score
+from sampling import (
+    FfmpegFrameReader,
+    FramePipeline,
+    FrameReader,
+    SamplerMode,
+    SamplingOptions,
+    get_keyframes,
+    get_sample_times,
+    init_decode_worker,
+    open_frame_reader,
+    read_frames,
+)
+from video import CellMeanExtractor, FrameDiffGate, get_reference_palette
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterable
+
+# seconds between samples
+SAMPLE_STEP = 5
+# seconds between frames scored by the grid detector while looking for the table
+GRID_SCAN_STEP = 30
+# grid scores at or above this get the table models run on them straight away.
+# Boards scored at least this on 154 of the 155 stored frames showing one.
+CLEAR_GRID_SCORE = 0.75
+# frames scoring under this are never given to the table models
+MIN_GRID_SCORE = 0.3
+# most frames under CLEAR_GRID_SCORE the table models are run on
+MAX_UNCLEAR_ATTEMPTS = 5
+# seconds between the frames the table models are run on when none of the
+# grid detector's candidates had the table
+TABLE_FALLBACK_STEP = 120
+
+
+class MatchWithVideo(Match):
+    def __init__(
+        self,
+        match: Match,
+        video_filename: str,
+        debug: bool = False,
+        table_batch: int = 1,
+        crop_ocr: bool = False,
+    ):
+        self.__dict__.update(match.__dict__)
+        self.video_filename = video_filename
+        self.debug = debug
+        # candidate frames the table models run on at once while looking for
+        # the table, keeping the one where the most cells have text
+        self.table_batch = table_batch
+        # run OCR only on the part of a frame that can hold the table
+        self.crop_ocr = crop_ocr
+
+        self.cap = cv2.VideoCapture(video_filename)
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_name = os.path.join(self.dir, "frame.png")
+
+        with telemetry.stage("get_table"):
+            self.table = self.get_table()
+        self.cell_extractor = CellMeanExtractor(self.table)
+        # for the frames from the sampling reader, which can be cropped
+        self.sample_extractor = self.cell_extractor
+        # (time, cell means) of every sample while options.save_raw_colors is on
+        self.raw_colors: list[tuple[float, numpy.ndarray]] | None = None
+        # set while options.diff_threshold is on
+        self.frame_gate: FrameDiffGate | None = None
+        # frames decoded by every reader this match has closed, shards included
+        self.frames_decoded = 0
+        # see get_keyframes
+        self.keyframes: list[int] | None = None
+        self.keyframes_read = False
+
+    def move_to_sec(self, sec: float):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.fps * sec)
+
+    def get_table(self) -> list[Square]:
+        table_json_name = os.path.join(self.dir, "table.json")
+        if os.path.isfile(table_json_name):
+            return deserialize_board_file(table_json_name)
+
+        # PaddleOCR is slow to import and only needed the first time
+        from find_table import get_best_table_from_image
+
+        # Unfortunately the best video quality for this is 360p.
+        if self.id == "2__Marshmallow__CodeMeRight1":
+            raise Exception(
+                "Video quality too poor for OCR. Create table.json manually"
+            )
+
+        height = self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        # for some reason yt-dlp will sometimes download a low quality video even
+        # when a higher quality video is available. In that case just throw
+        # an exception and we'll retry later
+        if height < 700:
+            self.cap.release()
+            os.remove(self.video_filename)
+            raise Exception("Video quality too poor for OCR. Try again")
+        print(f"Starting to OCR for id {self.id}")
+        time = self.board_start
+        max_time = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.fps
+
+        override_path = os.path.join(self.dir, "ocr_override_frame.png")
+        if os.path.isfile(override_path):
+            telemetry.count("ocr_attempts")
+            with telemetry.stage("find_table"):
+                table = get_best_table_from_image(
+                    override_path, self.debug, self.dir, self.crop_ocr
+                )
+
+            if table is None:
+                raise Exception(
+                    f"Failed to find table in override frame for id {self.id}"
+                )
+
+            print(f"Done OCRing table for id {self.id}")
+
+            serialize_board_to_file(table, table_json_name)
+            return table
+
+        # The grid detector takes milliseconds where the models take seconds, so
+        # frames are scored with it every GRID_SCAN_STEP seconds and the models
+        # only run on ones that look like they show the board. Frames that
+        # clearly do are tried as soon as there are table_batch of them, so a
+        # board that's up from the start still takes one attempt.
+        clear: list[tuple[float, cv2.typing.MatLike]] = []
+        unclear: list[tuple[float, float]] = []
+        tried: set[float] = set()
+        while time <= max_time:
+            frame = self.read_frame_at(time)
+            if frame is None:
+                break
+            grid_score = get_grid_score(frame)
+            if grid_score.score >= CLEAR_GRID_SCORE:
+                clear.append((time, frame))
+                if len(clear) == self.table_batch:
+                    table = self.find_table_in_frames(clear)
+                    if table is not None:
+                        serialize_board_to_file(table, table_json_name)
+                        return table
+                    tried.update(clear_time for clear_time, _ in clear)
+                    clear = []
+            elif grid_score.score >= MIN_GRID_SCORE:
+                unclear.append((grid_score.score, time))
+            else:
+                telemetry.count("frames_without_grid")
+            time += GRID_SCAN_STEP
+
+        # where reading stopped, so the fallback doesn't try past a cut off video
+        scan_end = time
+
+        # then any clear frames left over, and the frames where the grid was
+        # less clear, best first
+        unclear.sort(reverse=True)
+        unclear_times = [time for _, time in unclear[:MAX_UNCLEAR_ATTEMPTS]]
+        # The detector can still miss a board, so after its candidates the
+        # models run every TABLE_FALLBACK_STEP seconds like they did before
+        # it, skipping frames they've already seen
+        tried.update(clear_time for clear_time, _ in clear)
+        tried.update(unclear_times)
+        fallback_times = [
+            time
+            for time in get_sample_times(
+                self.board_start, max_time, TABLE_FALLBACK_STEP
+            )
+            if time < scan_end and time not in tried
+        ]
+        batches = [
+            times[start : start + self.table_batch]
+            for times in [unclear_times, fallback_times]
+            for start in range(0, len(times), self.table_batch)
+        ]
+        for batch in itertools.chain(
+            [clear], (self.read_frames_at(times) for times in batches)
+        ):
+            if len(batch) == 0:
+                continue
+            table = self.find_table_in_frames(batch)
+            if table is not None:
+                serialize_board_to_file(table, table_json_name)
+                return table
+        raise Exception(f"Failed to find table at ANY time for id {self.id}")
+
+    def read_frame_at(self, time: float) -> cv2.typing.MatLike | None:
+        self.move_to_sec(time)
+        ret, frame = self.cap.read()
+        if not ret:
+            print(f"Failed to read video at time {time} for ID: {self.id}")
+            return None
+        return frame
+
+    def read_frames_at(
+        self, times: list[float]
+    ) -> list[tuple[float, cv2.typing.MatLike]]:
+        frames: list[tuple[float, cv2.typing.MatLike]] = []
+        for time in times:
+            frame = self.read_frame_at(time)
+            if frame is not None:
+                frames.append((time, frame))
+        return frames
+
+    def find_table_in_frame(
+        self, frame: cv2.typing.MatLike, time: float
+    ) -> list[Square] | None:
+        from find_table import get_best_table_from_frame
+
+        # manual frame in case background is too noisy
+        # only relevant for mordaak vs stnfwds
+        # frame = cv2.imread("manual_frame.png")
+        # frame = cv2.imread("maual_frame_glove_redrobot.png")
+
+        if self.debug:
+            cv2.imwrite(self.frame_name, frame)
+        telemetry.count("ocr_attempts")
+        with telemetry.stage("find_table"):
+            table = get_best_table_from_frame(
+                frame, self.debug, self.dir, self.crop_ocr
+            )
+
+        if table is None:
+            print(f"Failed to find table at time {time} for id {self.id}")
+            return None
+
+        print(f"Done OCRing table for id {self.id}")
+        return table
+
+    def find_table_in_frames(
+        self, frames: list[tuple[float, cv2.typing.MatLike]]
+    ) -> list[Square] | None:
+        if len(frames) == 1:
+            return self.find_table_in_frame(frames[0][1], frames[0][0])
+
+        from find_table import get_best_table_from_frames
+
+        telemetry.count("ocr_attempts", len(frames))
+        with telemetry.stage("find_table"):
+            best = get_best_table_from_frames(
+                [frame for _, frame in frames], self.crop_ocr
+            )
+
+        times = ", ".join(str(time) for time, _ in frames)
+        if best is None:
+            print(f"Failed to find table at times {times} for id {self.id}")
+            return None
+
+        index, table = best
+        if self.debug:
+            cv2.imwrite(self.frame_name, frames[index][1])
+        print(f"Done OCRing table for id {self.id} from time {frames[index][0]}")
+        return table
+
+    def get_colors(
+        self,
+        frame: cv2.typing.MatLike,
+        color_mask: numpy.ndarray,
+        time: float,
+    ) -> None | list[Color]:
+        gate = self.frame_gate
+        if gate is not None:
+            check_start = perf_counter()
+            unchanged = gate.is_unchanged(
+                self.sample_extractor.get_thumbnail_means(frame)
+            )
+            gate.check_secs += perf_counter() - check_start
+            if unchanged:
+                telemetry.count("gate_reuses")
+                # the cache gets this frame's own means, so it's a record of the
+                # video and not of the gate. A replay classifies every sample,
+                # so it can differ from this run where the gate hid a change
+                # under the threshold.
+                if self.raw_colors is not None:
+                    self.raw_colors.append(
+                        (time, self.sample_extractor.get_means(frame))
+                    )
+                return gate.colors
+            classify_start = perf_counter()
+        means = self.sample_extractor.get_means(frame)
+        if self.raw_colors is not None:
+            self.raw_colors.append((time, means))
+        colors = self.classify_means(means, color_mask, time)
+        if gate is not None:
+            gate.classify_secs += perf_counter() - classify_start
+            gate.store(colors)
+        return colors
+
+    def get_square_color(
+        self,
+        frame: cv2.typing.MatLike,
+        color_mask: numpy.ndarray,
+        square_index: int,
+    ) -> Color:
+        means = self.cell_extractor.get_means(frame, [square_index])
+        color = get_reference_palette().classify(means, color_mask)[0]
+        return self.correct_color(square_index, color)
+
+    # The keyframes are only read for the sequential reader, and only once, so
+    # refining change times reuses the ones from sampling
+    def get_keyframes(self) -> list[int] | None:
+        if not self.keyframes_read:
+            self.keyframes = get_keyframes(self.video_filename)
+            self.keyframes_read = True
+        return self.keyframes
+
+    def open_frame_reader(self, mode: SamplerMode) -> FrameReader:
+        keyframes = None
+        if mode == SamplerMode.SEQUENTIAL:
+            keyframes = self.get_keyframes()
+        return open_frame_reader(mode, self.cap, self.fps, keyframes)
+
+    def open_sample_reader(
+        self, options: SamplingOptions, times: list[float], step: float
+    ) -> FrameReader:
+        # with no times there would be nothing for ffmpeg to select
+        if options.mode == SamplerMode.FFMPEG and len(times) > 0:
+            if options.max_stride > 1:
+                raise Exception("The ffmpeg sampler can't backtrack for max_stride")
+            extractor = self.cell_extractor
+            reader = FfmpegFrameReader(
+                self.cap,
+                self.fps,
+                self.video_filename,
+                times,
+                step,
+                (extractor.x_min, extractor.x_max, extractor.y_min, extractor.y_max),
+                options.ffmpeg_scale,
+            )
+        else:
+            reader = self.open_frame_reader(options.mode)
+        self.sample_extractor = CellMeanExtractor(reader.map_table(self.table))
+        return reader
+
+    def close_sample_reader(self, reader: FrameReader):
+        self.frames_decoded += reader.frames_decoded
+        telemetry.count("frames_decoded", reader.frames_decoded)
+        telemetry.count("frames_skipped", reader.frames_skipped)
+        telemetry.count("seeks", reader.seeks)
+        reader.close()
+        self.sample_extractor = self.cell_extractor
+
+    def start_sampling(self, options: SamplingOptions):
+        if options.save_raw_colors:
+            self.raw_colors = []
+        if options.diff_threshold is not None:
+            self.frame_gate = FrameDiffGate(options.diff_threshold)
+
+    def print_reader_stats(self, reader: FrameReader, num_times: int):
+        print(
+            f"Decoded {reader.frames_decoded} frames for {num_times} sample times, "
+            f"skipped {reader.frames_skipped}, seeked {reader.seeks} times "
+            f"for id {self.id}"
+        )
+        if self.frame_gate is not None:
+            print(f"{self.frame_gate.get_stats()} for id {self.id}")
+
+    # returns the classified samples, leaving out occluded frames and repeated
+    # samples as in Match.add_sample, plus the last frame that was read.
+    # Dropping repeats keeps the lists small when they come back from a shard.
+    def sample_colors(
+        self,
+        frames: Iterable[tuple[float, cv2.typing.MatLike]],
+        color_mask: numpy.ndarray,
+    ) -> tuple[list[tuple[float, list[Color]]], cv2.typing.MatLike | None]:
+        samples: list[tuple[float, list[Color]]] = []
+        last_frame = None
+        for time, frame in frames:
+            last_frame = frame
+            # cv2.imwrite(self.frame_name, frame)
+            colors = self.get_colors(frame, color_mask, time)
+            if colors is None:
+                continue
+            Match.add_sample(samples, time, colors)
+        return samples, last_frame
+
+    # Like sample_colors, but the stride grows while the board stays the same.
+    # When a sample after a long stride differs from the one before it, the
+    # skipped samples are read at the base stride so no intermediate state is
+    # missed. A change that is undone within a single stride can be missed,
+    # which is why max_stride should stay well under how long a square stays
+    # marked.
+    def sample_colors_adaptive(
+        self,
+        reader: FrameReader,
+        times: list[float],
+        color_mask: numpy.ndarray,
+        max_stride: int,
+    ) -> tuple[list[tuple[float, list[Color]]], cv2.typing.MatLike | None]:
+        samples: list[tuple[float, list[Color]]] = []
+        last_frame = None
+        last_frame_index = -1
+        # the sample that ended a long stride, so it isn't decoded again after
+        # backtracking. Until it's reached again the stride stays at 1
+        pending: tuple[int, list[Color] | None] | None = None
+        last_index = -1
+        last_colors = None
+        stride = 1
+        index = 0
+        while index < len(times):
+            time = times[index]
+            if pending is not None and pending[0] == index:
+                colors = pending[1]
+                pending = None
+            else:
+                frame = reader.read_at(time)
+                if frame is None:
+                    colors = None
+                else:
+                    if index > last_frame_index:
+                        last_frame = frame
+                        last_frame_index = index
+                    colors = self.get_colors(frame, color_mask, time)
+            if stride > 1 and colors != last_colors:
+                pending = (index, colors)
+                stride = 1
+                index = last_index + 1
+                continue
+            if colors is not None:
+                Match.add_sample(samples, time, colors)
+                if colors == last_colors and pending is None:
+                    stride = min(2 * stride, max_stride)
+                last_colors = colors
+            last_index = index
+            # always look at the last sample so a change at the end isn't skipped
+            index = min(index + stride, len(times) - 1)
+            if index == last_index:
+                break
+        return samples, last_frame
+
+    def sample_range(
+        self,
+        reader: FrameReader,
+        times: list[float],
+        color_mask: numpy.ndarray,
+        options: SamplingOptions,
+    ) -> tuple[list[tuple[float, list[Color]]], cv2.typing.MatLike | None]:
+        if options.max_stride > 1:
+            if options.pipeline_size > 0:
+                raise Exception("Adaptive sampling can't run in a pipeline")
+            return self.sample_colors_adaptive(
+                reader, times, color_mask, options.max_stride
+            )
+        if options.pipeline_size > 0:
+            pipeline = FramePipeline(reader, times, options.pipeline_size)
+            result = self.sample_colors(pipeline, color_mask)
+            print(f"{pipeline.get_stats()} for id {self.id}")
+            return result
+        return self.sample_colors(read_frames(reader, times), color_mask)
+
+    # samples times with a reader of its own, which is closed even if sampling
+    # fails, so an ffmpeg reader's process doesn't outlive it
+    def sample_times(
+        self,
+        times: list[float],
+        color_mask: numpy.ndarray,
+        options: SamplingOptions,
+    ) -> tuple[list[tuple[float, list[Color]]], cv2.typing.MatLike | None]:
+        reader = self.open_sample_reader(options, times, SAMPLE_STEP)
+        try:
+            samples, last_frame = self.sample_range(reader, times, color_mask, options)
+            if last_frame is not None:
+                last_frame = reader.get_full_frame(last_frame)
+            self.print_reader_stats(reader, len(times))
+        finally:
+            self.close_sample_reader(reader)
+        return samples, last_frame
+
+    def sample_colors_sharded(
+        self,
+        times: list[float],
+        color_mask: numpy.ndarray,
+        options: SamplingOptions,
+    ) -> tuple[list[tuple[float, list[Color]]], cv2.typing.MatLike | None]:
+        bounds = [i * len(times) // options.shards for i in range(options.shards + 1)]
+        shards = [times[bounds[i] : bounds[i + 1]] for i in range(options.shards)]
+        samples: list[tuple[float, list[Color]]] = []
+        last_frame = None
+        keyframes = None
+        if options.mode == SamplerMode.SEQUENTIAL:
+            keyframes = self.get_keyframes()
+        with ProcessPoolExecutor(
+            max_workers=options.shards, initializer=init_decode_worker
+        ) as executor:
+            futures = [
+                executor.submit(
+                    sample_shard,
+                    self.row,
+                    self.output_root,
+                    self.video_filename,
+                    shard,
+                    options,
+                    color_mask,
+                    keyframes,
+                    telemetry.is_enabled(),
+                )
+                for shard in shards
+            ]
+            for future in futures:
+                (
+                    shard_samples,
+                    shard_last_frame,
+                    shard_raw_colors,
+                    shard_frames_decoded,
+                    shard_telemetry,
+                    log,
+                ) = future.result()
+                print(log, end="")
+                telemetry.merge(shard_telemetry, "shard")
+                samples.extend(shard_samples)
+                self.frames_decoded += shard_frames_decoded
+                if self.raw_colors is not None and shard_raw_colors is not None:
+                    self.raw_colors.extend(shard_raw_colors)
+                if shard_last_frame is not None:
+                    last_frame = shard_last_frame
+        return samples, last_frame
+
+    def get_samples(
+        self,
+        options: SamplingOptions,
+        color_mask: numpy.ndarray,
+    ) -> list[tuple[float, list[Color]]]:
+        print(f"Starting to get distinct states for id {self.id}")
+        max_time = self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.fps
+        times = get_sample_times(self.board_start, max_time, SAMPLE_STEP)
+        self.start_sampling(options)
+        if options.shards > 1:
+            # every shard samples its own time range with its own capture, and
+            # the samples are stitched back together in order before filtering
+            # transitions, so a change that straddles a shard boundary is
+            # handled exactly like it is in a serial run
+            samples, last_frame = self.sample_colors_sharded(times, color_mask, options)
+        else:
+            samples, last_frame = self.sample_times(times, color_mask, options)
+        if last_frame is not None:
+            cv2.imwrite(self.frame_name, last_frame)
+        if self.raw_colors is not None:
+            self.save_raw_colors(self.raw_colors)
+            self.raw_colors = None
+        self.frame_gate = None
+        return samples
+
+    def get_distinct_states(
+        self,
+        options: SamplingOptions,
+    ) -> list[tuple[float, list[Color]]]:
+        with telemetry.stage("sampling"):
+            samples = self.get_samples(options, self.get_color_mask())
+        return Match.get_states_from_samples(samples)
+
+    # Each change is stamped with the first sample that showed it, so it can be
+    # up to a stride late. Bisect between that sample and the one before it,
+    # which is the last one that showed the old state, classifying only the
+    # changed square, to find the first frame that shows the new color. This
+    # costs about log2(gap in frames) decodes per change.
+    def refine_change_times(
+        self,
+        changelog: list[Change],
+        samples: list[tuple[float, list[Color]]],
+        color_mask: numpy.ndarray,
+        options: SamplingOptions,
+    ) -> list[Change]:
+        reader = self.open_frame_reader(options.mode)
+        previous_times = {
+            samples[i][0]: samples[i - 1][0] for i in range(1, len(samples))
+        }
+        refined: list[Change] = []
+        for change in changelog:
+            low = reader.get_frame_index(previous_times[change.time])
+            high = reader.get_frame_index(change.time)
+            while high - low > 1:
+                middle = (low + high) // 2
+                frame = reader.read_frame(middle)
+                if frame is not None and (
+                    self.get_square_color(frame, color_mask, change.square_index)
+                    == change.color
+                ):
+                    high = middle
+                else:
+                    low = middle
+            refined.append(
+                Change(
+                    time=high / self.fps,
+                    square_index=change.square_index,
+                    color=change.color,
+                )
+            )
+        print(
+            f"Refined {len(changelog)} change times with "
+            f"{reader.frames_decoded} decodes for id {self.id}"
+        )
+        self.frames_decoded += reader.frames_decoded
+        telemetry.count("refine_decodes", reader.frames_decoded)
+        # changes from the same sample can now be in a different order
+        refined.sort(key=lambda change: change.time)
+        return refined
+
+    def get_changelog(
+        self,
+        options: SamplingOptions | None = None,
+        refine_times: bool = False,
+    ) -> tuple[bool, list[Change]]:
+        if options is None:
+            options = SamplingOptions()
+        color_mask = self.get_color_mask()
+        with telemetry.stage("sampling"):
+            samples = self.get_samples(options, color_mask)
+        states = Match.get_states_from_samples(samples)
+        changelog = Match.get_changelog_from_states(states)
+        if refine_times:
+            with telemetry.stage("refine_times"):
+                changelog = self.refine_change_times(
+                    changelog, samples, color_mask, options
+                )
+
+        return self.write_changelog(changelog), changelog
+
+
+# runs in a worker process for MatchWithVideo.sample_colors_sharded
+def sample_shard(
+    row: list[str],
+    output_root: str,
+    video_filename: str,
+    times: list[float],
+    options: SamplingOptions,
+    color_mask: numpy.ndarray,
+    keyframes: list[int] | None,
+    telemetry_enabled: bool,
+) -> tuple[
+    list[tuple[float, list[Color]]],
+    cv2.typing.MatLike | None,
+    list[tuple[float, numpy.ndarray]] | None,
+    int,
+    dict[str, Any] | None,
+    str,
+]:
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        with_video = MatchWithVideo(Match(row, output_root), video_filename)
+        if telemetry_enabled:
+            telemetry.start(with_video.id)
+        with_video.keyframes = keyframes
+        with_video.keyframes_read = True
+        with_video.start_sampling(options)
+        try:
+            samples, last_frame = with_video.sample_times(times, color_mask, options)
+        finally:
+            with_video.cap.release()
+    return (
+        samples,
+        last_frame,
+        with_video.raw_colors,
+        with_video.frames_decoded,
+        telemetry.finish(),
+        log.getvalue(),
+    )
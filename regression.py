@@ -0,0 +1,302 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from enum import StrEnum
+from typing import Any
+
+import telemetry
+from changelog import Change, deserialize_changelog_file
+from match import GoalCompletion, Match
+from parse_csv import get_all_matches
+from sampling import SamplerMode, SamplingOptions, init_decode_worker
+
+# Reruns the matches in output/ and compares each new changelog with the one
+# stored there, square by square, along with the final score check and how
+# long and how much memory it took. That way a change meant to make things
+# faster can be checked for both at once.
+#
+# Every match is rebuilt under a scratch output root so the stored changelogs
+# are never touched, and in a process of its own so the memory high-water
+# mark belongs to that match alone.
+
+
+class Source(StrEnum):
+    # the video if it's downloaded, otherwise raw_colors.npy
+    AUTO = "auto"
+    VIDEO = "video"
+    RAW_COLORS = "raw"
+
+
+# files copied from output/<id> so the scratch match classifies the same way
+INPUT_FILES = ["table.json", "color_restrictions.json"]
+
+
+# telemetry stages that time reading frames, for how much of a match was spent
+# decoding. Shards add theirs up, so with shards it's more than the wall time.
+DECODE_STAGES = ["decode", "grab", "seek"]
+
+
+def get_max_rss_mb() -> float | None:
+    # resource is Unix only
+    try:
+        import resource
+    except ImportError:
+        return None
+    # children are ffmpeg and the shard workers, once they've exited. Theirs is
+    # the largest of them, not the total
+    max_rss = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return max_rss / 2**20
+    return max_rss / 2**10
+
+
+# Pairs up each square's changes in order. Squares whose sequence of colors
+# differs are listed, and for the rest the time differences are measured.
+def diff_changelogs(stored: list[Change], new: list[Change]) -> dict[str, Any]:
+    different_squares: list[int] = []
+    time_diffs: list[float] = []
+    for square_index in range(0, 25):
+        stored_changes = [c for c in stored if c.square_index == square_index]
+        new_changes = [c for c in new if c.square_index == square_index]
+        if [c.color for c in stored_changes] != [c.color for c in new_changes]:
+            different_squares.append(square_index)
+            continue
+        time_diffs.extend(
+            abs(n.time - s.time) for s, n in zip(stored_changes, new_changes)
+        )
+    return {
+        "identical": different_squares == [] and all(diff == 0 for diff in time_diffs),
+        "stored_changes": len(stored),
+        "new_changes": len(new),
+        "squares_with_different_colors": different_squares,
+        "max_time_diff": max(time_diffs, default=0.0),
+        "mean_time_diff": sum(time_diffs) / len(time_diffs) if time_diffs else 0.0,
+    }
+
+
+# which source to rerun the match from, or None if it has neither
+def get_source(match: Match, source: Source) -> Source | None:
+    has_video = match.get_video_filename() is not None
+    if source == Source.AUTO:
+        source = Source.VIDEO if has_video else Source.RAW_COLORS
+    if source == Source.VIDEO and not has_video:
+        return None
+    if source == Source.RAW_COLORS and not os.path.isfile(match.raw_colors_name):
+        return None
+    return source
+
+
+def stored_score_matches(match: Match) -> bool:
+    stored = deserialize_changelog_file(os.path.join(match.dir, "changelog.txt"))
+    stats = GoalCompletion.get_final_stats(stored, match.id)
+    return stats is not None and GoalCompletion.verify_stats(stats, match)
+
+
+def check_match(
+    match: Match,
+    source: Source,
+    options: SamplingOptions,
+    refine_times: bool,
+    scratch_root: str,
+) -> dict[str, Any]:
+    result: dict[str, Any] = {"id": match.id, "source": source.value}
+    scratch = Match(match.row, scratch_root)
+    for fname in os.listdir(scratch.dir):
+        os.remove(os.path.join(scratch.dir, fname))
+    for fname in INPUT_FILES:
+        if os.path.isfile(os.path.join(match.dir, fname)):
+            shutil.copy(os.path.join(match.dir, fname), scratch.dir)
+
+    # collect what the match prints so parallel workers don't interleave
+    log = io.StringIO()
+    start_time = time.perf_counter()
+    telemetry.start(match.id)
+    try:
+        with contextlib.redirect_stdout(log):
+            if source == Source.VIDEO:
+                from match_with_video import MatchWithVideo
+
+                with_video = MatchWithVideo(scratch, match.get_video_filename())
+                try:
+                    score_matches, _ = with_video.get_changelog(options, refine_times)
+                finally:
+                    with_video.cap.release()
+                result["frames"] = with_video.frames_decoded
+            else:
+                shutil.copy(match.raw_colors_name, scratch.dir)
+                score_matches, _ = scratch.replay_changelog()
+                result["frames"] = len(scratch.load_raw_colors())
+    except Exception:
+        result["error"] = traceback.format_exc()
+        return result
+    finally:
+        result["log"] = log.getvalue()
+        record = telemetry.finish()
+    result["secs"] = time.perf_counter() - start_time
+    result["decode_secs"] = sum(
+        record["stages"][name]["wall_secs"]
+        for name in DECODE_STAGES
+        if name in record["stages"]
+    )
+    result["max_rss_mb"] = get_max_rss_mb()
+    result["score_matches"] = score_matches
+    # read back from disk so both changelogs have been through the same
+    # rounding
+    stored = deserialize_changelog_file(os.path.join(match.dir, "changelog.txt"))
+    new = deserialize_changelog_file(os.path.join(scratch.dir, "changelog.txt"))
+    result.update(diff_changelogs(stored, new))
+    return result
+
+
+def print_report(results: list[dict[str, Any]], wall_time: float):
+    checked = [r for r in results if "secs" in r]
+    errors = [r for r in results if "error" in r]
+    skipped = [r for r in results if "skipped" in r]
+    different = [r for r in checked if not r["identical"]]
+    wrong_scores = [
+        r for r in checked if r["score_matches"] != r["stored_score_matches"]
+    ]
+    print(f"Checked {len(checked)} of {len(results)} matches, skipped {len(skipped)}")
+    print(f"Errors: {len(errors)}")
+    for result in errors:
+        print(f"    {result['id']}")
+        print(result["error"])
+    print(f"Changelogs that differ: {len(different)}")
+    for result in different:
+        print(
+            f"    {result['id']}: squares with different colors "
+            f"{result['squares_with_different_colors']}, max time difference "
+            f"{result['max_time_diff']:.2f}s"
+        )
+    print(f"Final score check changed: {len(wrong_scores)}")
+    for result in wrong_scores:
+        print(
+            f"    {result['id']}: stored {result['stored_score_matches']}, "
+            f"now {result['score_matches']}"
+        )
+    if len(checked) > 0:
+        total_secs = sum(r["secs"] for r in checked)
+        decode_secs = sum(r["decode_secs"] for r in checked)
+        total_frames = sum(r["frames"] for r in checked)
+        max_rss = [r["max_rss_mb"] for r in checked if r["max_rss_mb"] is not None]
+        print(
+            f"Total {total_secs:.1f}s for {total_frames} frames "
+            f"({total_frames / max(total_secs, 1e-9):.0f} frames/s), "
+            f"{decode_secs:.1f}s of it decoding, "
+            f"highest memory {max(max_rss, default=0):.0f} MB"
+        )
+    print(f"Total wall time: {wall_time:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--source",
+        type=Source,
+        choices=list(Source),
+        default=Source.AUTO,
+        help="rerun from the video or from raw_colors.npy",
+    )
+    parser.add_argument("ids", nargs="*", help="only check these matches")
+    parser.add_argument(
+        "--sampler",
+        type=SamplerMode,
+        choices=list(SamplerMode),
+        default=SamplerMode.SEEK,
+    )
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--max-stride", type=int, default=1)
+    parser.add_argument("--diff-threshold", type=float, default=None)
+    parser.add_argument("--ffmpeg-scale", type=float, default=1.0)
+    parser.add_argument("--pipeline-size", type=int, default=0)
+    parser.add_argument("--refine-times", action="store_true")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="matches to check in parallel. More than 1 makes the times noisier",
+    )
+    parser.add_argument("--scratch-root", default="regression_output")
+    parser.add_argument("--report", default="regression_report.json")
+    args = parser.parse_args()
+    options = SamplingOptions(
+        mode=args.sampler,
+        shards=args.shards,
+        max_stride=args.max_stride,
+        diff_threshold=args.diff_threshold,
+        ffmpeg_scale=args.ffmpeg_scale,
+        pipeline_size=args.pipeline_size,
+    )
+
+    matches = [
+        match
+        for match in get_all_matches()
+        if os.path.isfile(os.path.join(match.dir, "changelog.txt"))
+        and (len(args.ids) == 0 or match.id in args.ids)
+    ]
+    sources = {match.id: get_source(match, args.source) for match in matches}
+    runnable = [match for match in matches if sources[match.id] is not None]
+    print(
+        f"Checking {len(runnable)} of {len(matches)} matches, the rest have "
+        f"no video or raw colors"
+    )
+    start_time = time.time()
+    # a fresh process per match, so ru_maxrss is that match's alone
+    with ProcessPoolExecutor(
+        max_workers=args.workers, max_tasks_per_child=1, initializer=init_decode_worker
+    ) as executor:
+        futures = [
+            executor.submit(
+                check_match,
+                match,
+                sources[match.id],
+                options,
+                args.refine_times,
+                args.scratch_root,
+            )
+            for match in runnable
+        ]
+        results_by_id = {
+            match.id: future.result() for match, future in zip(runnable, futures)
+        }
+    wall_time = time.time() - start_time
+    results: list[dict[str, Any]] = []
+    for match in matches:
+        result = results_by_id.get(match.id, {"id": match.id, "skipped": True})
+        result["stored_score_matches"] = stored_score_matches(match)
+        results.append(result)
+
+    report = {
+        "time": start_time,
+        "settings": {
+            "source": args.source.value,
+            "sampler": args.sampler.value,
+            "shards": args.shards,
+            "max_stride": args.max_stride,
+            "diff_threshold": args.diff_threshold,
+            "ffmpeg_scale": args.ffmpeg_scale,
+            "pipeline_size": args.pipeline_size,
+            "refine_times": args.refine_times,
+        },
+        "wall_secs": wall_time,
+        "matches": results,
+    }
+    with open(args.report, "w") as file:
+        json.dump(report, file, indent=2)
+    print_report(results, wall_time)
+    print(f"Wrote {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+import bisect
+import math
+from abc import ABC, abstractmethod
+import queue
+import subprocess
+import tempfile
+import threading
+import cv2
+import numpy
+from enum import StrEnum
+from time import perf_counter
+from typing import Iterator
+
+import telemetry
+from square import Square
+
+
+# Sampling every 5s of a 5 min 1080p30 H.264 file on one core:
+#   keyframe every 5s, samples between keyframes: seek 2.3, sequential 3.0 samples/s
+#   keyframe every 5s, samples on keyframes:      seek 1.3, sequential 1.5 samples/s
+#   keyframe every 10s, samples between keyframes: seek 2.9, sequential 4.2 samples/s
+class SamplerMode(StrEnum):
+    # cap.set(CAP_PROP_POS_FRAMES) before every sample
+    SEEK = "seek"
+    # decode front to back, grab() skipped frames, only seek past keyframes
+    SEQUENTIAL = "sequential"
+    # ffmpeg decodes in its own process and only sends the table area of the
+    # sampled frames through a pipe. It decodes every frame, so on one core
+    # it took 4.0s to sequential's 1.5s for 100s of 1080p30 with a keyframe
+    # every 4s, but the decode can run on other cores alongside Python.
+    FFMPEG = "ffmpeg"
+
+
+class SamplingOptions:
+    def __init__(
+        self,
+        mode: SamplerMode = SamplerMode.SEEK,
+        # split the match into this many time ranges and sample each one in
+        # its own process
+        shards: int = 1,
+        # with more than 1, let the stride grow up to this many samples while
+        # the board doesn't change
+        max_stride: int = 1,
+        # write the cell means of every sample to raw_colors.npy so the match
+        # can be replayed without decoding the video again
+        save_raw_colors: bool = False,
+        # reuse the last classification while no cell's thumbnail mean moves
+        # by this much, see FrameDiffGate. None classifies every frame
+        diff_threshold: float | None = None,
+        # with the ffmpeg sampler, scale the cropped table by this much
+        ffmpeg_scale: float = 1.0,
+        # decode on a separate thread, queueing up to this many frames for
+        # classification. 0 decodes and classifies in turn
+        pipeline_size: int = 0,
+    ):
+        self.mode = mode
+        self.shards = shards
+        self.max_stride = max_stride
+        self.save_raw_colors = save_raw_colors
+        self.diff_threshold = diff_threshold
+        self.ffmpeg_scale = ffmpeg_scale
+        self.pipeline_size = pipeline_size
+
+
+# initializer for every pool of processes that decode video: matches run in
+# parallel and shards of a match. Each decodes its own video, so don't let
+# OpenCV spin up a thread per core in every process
+def init_decode_worker():
+    cv2.setNumThreads(1)
+
+
+def get_sample_times(start: float, end: float, step: float) -> list[float]:
+    # accumulate instead of multiplying so the times match the original
+    # `time += 5` loop exactly
+    times: list[float] = []
+    time = start
+    while time <= end:
+        times.append(time)
+        time += step
+    return times
+
+
+# Returns the indices of the keyframes in the video, or None if the container
+# can't be read in raw mode. This only demuxes packets, no decoding happens, so
+# it's fast even for long VODs. Indices are in packet order, which can be off
+# by a few frames from display order when there are B-frames, but it's only
+# used to decide whether seeking is cheaper than grabbing.
+def get_keyframes(video_filename: str) -> list[int] | None:
+    cap = cv2.VideoCapture(video_filename, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    if not cap.isOpened():
+        return None
+    keyframes: list[int] = []
+    index = 0
+    while cap.grab():
+        if cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(index)
+        index += 1
+    cap.release()
+    if len(keyframes) == 0:
+        return None
+    return keyframes
+
+
+# Reads single frames by index. Subclasses decide how to get there, e.g. by
+# seeking or by decoding forward.
+class FrameReader(ABC):
+    def __init__(self, cap: cv2.VideoCapture, fps: float):
+        self.cap = cap
+        self.fps = fps
+        self.frames_decoded = 0
+        self.frames_skipped = 0
+        self.seeks = 0
+
+    def get_frame_index(self, sec: float) -> int:
+        # same truncation that cap.set(CAP_PROP_POS_FRAMES, fps * sec) does
+        return int(self.fps * sec)
+
+    def read_at(self, sec: float) -> cv2.typing.MatLike | None:
+        return self.read_frame(self.get_frame_index(sec))
+
+    @abstractmethod
+    def read_frame(self, frame_index: int) -> cv2.typing.MatLike | None:
+        pass
+
+    # the table in the coordinates of the frames this reader returns
+    def map_table(self, table: list[Square]) -> list[Square]:
+        return table
+
+    # the full size version of a frame this reader returned
+    def get_full_frame(self, frame: cv2.typing.MatLike) -> cv2.typing.MatLike:
+        return frame
+
+    def close(self):
+        pass
+
+
+class SeekingFrameReader(FrameReader):
+    def read_frame(self, frame_index: int) -> cv2.typing.MatLike | None:
+        with telemetry.stage("seek"):
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        self.seeks += 1
+        with telemetry.stage("decode"):
+            has_frame, frame = self.cap.read()
+        if not has_frame:
+            return None
+        self.frames_decoded += 1
+        return frame
+
+
+# OpenCV's seek backs up this many frames from the target, jumps to the last
+# keyframe before that point and decodes forward from there
+OPENCV_SEEK_DELTA_FRAMES = 16
+# without keyframe info, grab() through gaps up to this long and seek otherwise
+MAX_BLIND_GRAB_SECS = 10
+
+
+class SequentialFrameReader(FrameReader):
+    def __init__(self, cap: cv2.VideoCapture, fps: float, keyframes: list[int] | None):
+        FrameReader.__init__(self, cap, fps)
+        self.keyframes = keyframes
+        self.position = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+
+    def should_seek(self, frame_index: int) -> bool:
+        if frame_index < self.position:
+            return True
+        if self.keyframes is None:
+            return frame_index - self.position > MAX_BLIND_GRAB_SECS * self.fps
+        # grabbing decodes every frame from the current position, seeking
+        # decodes from whichever keyframe OpenCV lands on
+        key_index = (
+            bisect.bisect_right(self.keyframes, frame_index - OPENCV_SEEK_DELTA_FRAMES)
+            - 1
+        )
+        if key_index < 0:
+            return False
+        return self.keyframes[key_index] > self.position
+
+    def read_frame(self, frame_index: int) -> cv2.typing.MatLike | None:
+        if self.should_seek(frame_index):
+            with telemetry.stage("seek"):
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            self.seeks += 1
+            self.position = frame_index
+        with telemetry.stage("grab"):
+            while self.position < frame_index:
+                if not self.cap.grab():
+                    return None
+                self.position += 1
+                self.frames_skipped += 1
+        with telemetry.stage("decode"):
+            has_frame, frame = self.cap.read()
+        if not has_frame:
+            return None
+        self.position += 1
+        self.frames_decoded += 1
+        return frame
+
+
+# Spawns ffmpeg to decode the video, crop it to the table and optionally scale
+# it down, and only pipe out the frames that get sampled. Sample k is frame
+# floor(fps * times[0] + fps * step * k), which select works out with a
+# counter in register 0 so it doesn't drift from the list in frame_indices.
+# Frames are selected by timestamp, the first one at or after half a frame
+# before the sample's frame, so dropped frames don't shift every sample after
+# them the way counting frames would.
+# Frames can only be read in increasing order, since there's no seeking back
+# in the pipe. frames_decoded counts frames that came out of the pipe.
+class FfmpegFrameReader(FrameReader):
+    def __init__(
+        self,
+        cap: cv2.VideoCapture,
+        fps: float,
+        video_filename: str,
+        times: list[float],
+        step: float,
+        # x_min, x_max, y_min, y_max of the area to keep
+        bounds: tuple[int, int, int, int],
+        scale: float,
+    ):
+        FrameReader.__init__(self, cap, fps)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        x_min, x_max, y_min, y_max = bounds
+        # crop on even pixels so the 4:2:0 chroma stays lined up with luma
+        self.crop_x = x_min - x_min % 2
+        self.crop_y = y_min - y_min % 2
+        self.crop_width = min(width, x_max + x_max % 2) - self.crop_x
+        self.crop_height = min(height, y_max + y_max % 2) - self.crop_y
+        self.width = max(2, 2 * round(self.crop_width * scale / 2))
+        self.height = max(2, 2 * round(self.crop_height * scale / 2))
+
+        first = fps * times[0]
+        stride = fps * step
+        self.frame_indices = [math.floor(first + stride * k) for k in range(len(times))]
+        self.sample_numbers = {time: k for k, time in enumerate(times)}
+        self.next_sample = 0
+        self.last_index = -1
+        # set once the pipe runs out, after which every read returns None
+        self.ended = False
+
+        # accurate input seeking, so the first frame out of the decoder is the
+        # first sample
+        seek_secs = 0.0
+        seek = []
+        if self.frame_indices[0] > 0:
+            seek_secs = (self.frame_indices[0] - 0.5) / fps
+            seek = ["-ss", repr(seek_secs)]
+        filters = [
+            # ffmpeg moves t so it's 0 at the start of the file plus the seek
+            f"select='if(gte(t,(floor({first!r}+{stride!r}*ld(0))-0.5)/{fps!r}"
+            f"-{seek_secs!r}),st(0,ld(0)+1),0)'",
+            f"crop={self.crop_width}:{self.crop_height}:{self.crop_x}:{self.crop_y}",
+        ]
+        if (self.width, self.height) != (self.crop_width, self.crop_height):
+            filters.append(f"scale={self.width}:{self.height}:flags=area")
+        # ffmpeg's errors go to a file rather than a pipe, so a lot of them
+        # can't fill the pipe and stall it while frames are being read
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                *seek,
+                "-i",
+                video_filename,
+                "-vf",
+                ",".join(filters),
+                "-fps_mode",
+                "passthrough",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "bgr24",
+                "-",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=self.errors,
+        )
+
+    def get_frame_index(self, sec: float) -> int:
+        sample_number = self.sample_numbers.get(sec)
+        if sample_number is None:
+            return FrameReader.get_frame_index(self, sec)
+        return self.frame_indices[sample_number]
+
+    def read_frame(self, frame_index: int) -> cv2.typing.MatLike | None:
+        sample_number = bisect.bisect_left(self.frame_indices, frame_index)
+        if (
+            sample_number == len(self.frame_indices)
+            or self.frame_indices[sample_number] != frame_index
+        ):
+            raise Exception(f"Frame {frame_index} isn't one of the sampled frames")
+        if self.ended:
+            return None
+        if sample_number < self.next_sample:
+            raise Exception("The ffmpeg reader can't go back to an earlier frame")
+        frame_bytes = self.width * self.height * 3
+        # includes waiting on ffmpeg to decode and crop the frame
+        with telemetry.stage("decode"):
+            while self.next_sample <= sample_number:
+                data = self.process.stdout.read(frame_bytes)
+                self.next_sample += 1
+                if len(data) < frame_bytes:
+                    self.ended = True
+                    self.check_exit(frame_index)
+                    return None
+                if self.next_sample <= sample_number:
+                    self.frames_skipped += 1
+        self.frames_decoded += 1
+        self.last_index = frame_index
+        # read only view of the pipe's bytes, no copy
+        return numpy.frombuffer(data, numpy.uint8).reshape(self.height, self.width, 3)
+
+    def map_table(self, table: list[Square]) -> list[Square]:
+        scale_x = self.width / self.crop_width
+        scale_y = self.height / self.crop_height
+        return [
+            Square(
+                x_min=(square.x_min - self.crop_x) * scale_x,
+                y_min=(square.y_min - self.crop_y) * scale_y,
+                x_max=(square.x_max - self.crop_x) * scale_x,
+                y_max=(square.y_max - self.crop_y) * scale_y,
+                text=square.text,
+            )
+            for square in table
+        ]
+
+    def get_full_frame(self, frame: cv2.typing.MatLike) -> cv2.typing.MatLike:
+        full_frame = SeekingFrameReader(self.cap, self.fps).read_frame(self.last_index)
+        return frame if full_frame is None else full_frame
+
+    # the pipe running out is the end of the video if ffmpeg exited cleanly,
+    # and anything else, e.g. a bad filter or a codec error, is an error
+    def check_exit(self, frame_index: int):
+        return_code = self.process.wait()
+        if return_code != 0:
+            self.errors.seek(0)
+            errors = self.errors.read().decode(errors="replace").strip()
+            raise Exception(
+                f"ffmpeg exited with {return_code} before frame {frame_index}: "
+                f"{errors}"
+            )
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+        self.errors.close()
+
+
+# the frames at times that could be read, in order
+def read_frames(
+    reader: FrameReader, times: list[float]
+) -> Iterator[tuple[float, cv2.typing.MatLike]]:
+    for time in times:
+        frame = reader.read_at(time)
+        if frame is not None:
+            yield time, frame
+
+
+# Like read_frames, but the reader runs on a background thread and fills a
+# queue of up to queue_size frames while the caller classifies the previous
+# ones. cap.read() and the ffmpeg pipe read both release the GIL, so decoding
+# and classifying overlap. There's a single decoder thread, so frames still
+# come out in the order of times.
+class FramePipeline:
+    def __init__(self, reader: FrameReader, times: list[float], queue_size: int):
+        self.reader = reader
+        self.times = times
+        self.queue_size = queue_size
+        self.frames: queue.Queue[tuple[float, cv2.typing.MatLike] | None] = queue.Queue(
+            maxsize=queue_size
+        )
+        self.stopped = threading.Event()
+        self.error: Exception | None = None
+        self.thread = threading.Thread(target=self.decode, daemon=True)
+        self.num_frames = 0
+        # summed over every get, to average
+        self.total_occupancy = 0
+        self.empty_gets = 0
+        self.wait_secs = 0.0
+        self.secs = 0.0
+
+    def decode(self):
+        try:
+            for item in read_frames(self.reader, self.times):
+                if not self.put(item):
+                    return
+        except Exception as e:
+            self.error = e
+        finally:
+            self.put(None)
+
+    # returns False if the consumer went away
+    def put(self, item: tuple[float, cv2.typing.MatLike] | None) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self) -> Iterator[tuple[float, cv2.typing.MatLike]]:
+        start_time = perf_counter()
+        self.thread.start()
+        try:
+            while True:
+                occupancy = self.frames.qsize()
+                self.total_occupancy += occupancy
+                if occupancy == 0:
+                    self.empty_gets += 1
+                wait_start = perf_counter()
+                item = self.frames.get()
+                self.wait_secs += perf_counter() - wait_start
+                if item is None:
+                    break
+                self.num_frames += 1
+                yield item
+        finally:
+            self.stopped.set()
+            self.thread.join()
+            self.secs = perf_counter() - start_time
+        if self.error is not None:
+            raise self.error
+
+    def get_stats(self) -> str:
+        gets = self.num_frames + 1
+        return (
+            f"Pipeline read {self.num_frames} frames in {self.secs:.1f}s "
+            f"({self.num_frames / max(self.secs, 1e-9):.1f} frames/s), the queue "
+            f"held {self.total_occupancy / gets:.1f} of {self.queue_size} on "
+            f"average and was empty for {100 * self.empty_gets / gets:.0f}% of "
+            f"gets, waited {self.wait_secs:.1f}s for frames"
+        )
+
+
+def open_frame_reader(
+    mode: SamplerMode,
+    cap: cv2.VideoCapture,
+    fps: float,
+    keyframes: list[int] | None,
+) -> FrameReader:
+    if mode == SamplerMode.SEEK:
+        return SeekingFrameReader(cap, fps)
+    if mode == SamplerMode.SEQUENTIAL:
+        return SequentialFrameReader(cap, fps, keyframes)
+    if mode == SamplerMode.FFMPEG:
+        # needs the sample times and table, see MatchWithVideo.open_sample_reader.
+        # Anything else that wants single frames can seek.
+        return SeekingFrameReader(cap, fps)
+    raise Exception(f"Unknown sampler mode {mode}")
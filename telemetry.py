@@ -0,0 +1,114 @@
+import json
+from time import perf_counter, process_time
+from typing import Any
+
+# Opt-in timers and counters for the video pipeline. The pipeline calls stage
+# and count unconditionally, and they do nothing unless start was called in
+# this process, so with telemetry off a stage costs a small object and two
+# None checks. Stages can nest, e.g. decode inside sampling, so their times
+# don't add up to the match's total. CPU time is for the whole process, so a
+# stage's CPU time includes other threads running at the same time.
+
+
+class MatchTelemetry:
+    def __init__(self, match_id: str):
+        self.match_id = match_id
+        self.start_wall = perf_counter()
+        self.start_cpu = process_time()
+        # name -> [calls, wall secs, cpu secs]
+        self.stages: dict[str, list[float]] = {}
+        self.counters: dict[str, int] = {}
+
+    def add_stage(self, name: str, wall_secs: float, cpu_secs: float, calls: int = 1):
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = [0, 0.0, 0.0]
+            self.stages[name] = totals
+        totals[0] += calls
+        totals[1] += wall_secs
+        totals[2] += cpu_secs
+
+    def get_record(self) -> dict[str, Any]:
+        return {
+            "id": self.match_id,
+            "wall_secs": perf_counter() - self.start_wall,
+            "cpu_secs": process_time() - self.start_cpu,
+            "stages": {
+                name: {"calls": calls, "wall_secs": wall_secs, "cpu_secs": cpu_secs}
+                for name, (calls, wall_secs, cpu_secs) in self.stages.items()
+            },
+            "counters": self.counters,
+        }
+
+
+current: MatchTelemetry | None = None
+
+
+class Stage:
+    __slots__ = ("name", "start_wall", "start_cpu")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start_wall: float | None = None
+
+    def __enter__(self) -> "Stage":
+        if current is not None:
+            self.start_wall = perf_counter()
+            self.start_cpu = process_time()
+        return self
+
+    def __exit__(self, *exc_info: Any):
+        if current is not None and self.start_wall is not None:
+            current.add_stage(
+                self.name,
+                perf_counter() - self.start_wall,
+                process_time() - self.start_cpu,
+            )
+
+
+# with stage("decode"): ...
+def stage(name: str) -> Stage:
+    return Stage(name)
+
+
+def count(name: str, amount: int = 1):
+    if current is not None:
+        current.counters[name] = current.counters.get(name, 0) + amount
+
+
+def is_enabled() -> bool:
+    return current is not None
+
+
+def start(match_id: str):
+    global current
+    current = MatchTelemetry(match_id)
+
+
+# stops recording and returns what was recorded, or None if it wasn't on
+def finish() -> dict[str, Any] | None:
+    global current
+    if current is None:
+        return None
+    record = current.get_record()
+    current = None
+    return record
+
+
+# adds a record from another process, e.g. a shard, to the current match. Its
+# wall and CPU totals become a stage of their own.
+def merge(record: dict[str, Any] | None, stage_name: str):
+    if current is None or record is None:
+        return
+    current.add_stage(stage_name, record["wall_secs"], record["cpu_secs"])
+    for name, totals in record["stages"].items():
+        current.add_stage(
+            name, totals["wall_secs"], totals["cpu_secs"], totals["calls"]
+        )
+    for name, amount in record["counters"].items():
+        count(name, amount)
+
+
+def write_record(filename: str, record: dict[str, Any]):
+    with open(filename, "a") as file:
+        file.write(json.dumps(record) + "\n")
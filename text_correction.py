@@ -1,6 +1,8 @@
 import difflib
+import heapq
 import os
 import json
+from collections import Counter
 
 
 def get_all_goals() -> list[str]:
@@ -12,21 +14,155 @@ def strip_text(input: str) -> str:
     return "".join(x.lower() for x in input if x.isalpha() or x.isdigit())
 
 
-if os.path.isfile("corrections.json"):
-    with open("corrections.json", "r") as f:
-        corrections: dict[str, str] = json.load(f)
-else:
+# Corrections are appended to a journal as they're added, one [bad, good] JSON
+# array per line, instead of rewriting the whole snapshot every time.
+# compact_corrections folds the journal back into the snapshot.
+CORRECTIONS_SNAPSHOT = "corrections.json"
+CORRECTIONS_JOURNAL = "corrections.jsonl"
+
+
+# returns the corrections and how many bytes of the journal are whole lines.
+# A crash in the middle of an append can only leave a partial last line, which
+# is ignored.
+def load_corrections() -> tuple[dict[str, str], int]:
     corrections: dict[str, str] = {}
+    if os.path.isfile(CORRECTIONS_SNAPSHOT):
+        with open(CORRECTIONS_SNAPSHOT, "r") as f:
+            corrections = json.load(f)
+    journal_length = 0
+    if os.path.isfile(CORRECTIONS_JOURNAL):
+        with open(CORRECTIONS_JOURNAL, "rb") as f:
+            journal = f.read()
+        for line in journal.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                bad_text, good_text = json.loads(line)
+            except ValueError:
+                break
+            corrections[bad_text] = good_text
+            journal_length += len(line)
+        if journal_length < len(journal):
+            print(f"Ignoring partial last line in {CORRECTIONS_JOURNAL}")
+    return corrections, journal_length
+
+
+corrections, journal_length = load_corrections()
+
+
+# bit i is set in char_masks[c] when word[i] == c
+def get_char_masks(word: str) -> dict[str, int]:
+    char_masks: dict[str, int] = {}
+    for i, char in enumerate(word):
+        char_masks[char] = char_masks.get(char, 0) | (1 << i)
+    return char_masks
+
+
+# length of the longest common subsequence, a row of the DP table at a time
+# with each row packed into an int (Hyyro's bit-parallel LCS)
+def get_lcs_length(text: str, word: str, char_masks: dict[str, int]) -> int:
+    all_bits = (1 << len(word)) - 1
+    row = all_bits
+    for char in text:
+        matches = row & char_masks.get(char, 0)
+        row = ((row + matches) | (row - matches)) & all_bits
+    return len(word) - row.bit_count()
+
+
+# Inverted index from each character to the goals that contain it and how many
+# times. Summing min(count in word, count in goal) over the word's characters
+# gives SequenceMatcher.quick_ratio against every goal at once, and that's an
+# upper bound on ratio. Goals are scored in order of that bound, stopping once
+# no goal left could make the top n, which gives exactly what
+# difflib.get_close_matches does without scoring every goal.
+class GoalIndex:
+    def __init__(self, goals: list[str]):
+        self.goals = goals
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+        for i, goal in enumerate(goals):
+            for char, count in Counter(goal).items():
+                self.postings.setdefault(char, []).append((i, count))
+
+    def get_quick_ratios(self, word: str) -> list[float]:
+        common = [0] * len(self.goals)
+        for char, count in Counter(word).items():
+            for i, goal_count in self.postings.get(char, []):
+                common[i] += min(count, goal_count)
+        # same float math as difflib's _calculate_ratio, so the bound is never
+        # below the ratio it bounds
+        return [
+            2.0 * matches / length if length else 1.0
+            for matches, length in zip(
+                common, (len(goal) + len(word) for goal in self.goals)
+            )
+        ]
+
+    def get_close_matches(self, word: str, n: int, cutoff: float) -> list[str]:
+        bounds = self.get_quick_ratios(word)
+        order = sorted(range(len(self.goals)), key=lambda i: bounds[i], reverse=True)
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        char_masks = get_char_masks(word)
+        # min heap of the best (ratio, goal) so far
+        best: list[tuple[float, str]] = []
+        for i in order:
+            min_ratio = best[0][0] if len(best) == n else cutoff
+            if bounds[i] < min_ratio:
+                break
+            goal = self.goals[i]
+            # the matching blocks ratio counts make up a common subsequence, so
+            # the longest one is a tighter bound that's still much cheaper than
+            # ratio itself
+            length = len(goal) + len(word)
+            lcs_length = get_lcs_length(goal, word, char_masks)
+            if length and 2.0 * lcs_length / length < min_ratio:
+                continue
+            matcher.set_seq1(goal)
+            ratio = matcher.ratio()
+            if ratio < cutoff:
+                continue
+            if len(best) < n:
+                heapq.heappush(best, (ratio, goal))
+            else:
+                heapq.heappushpop(best, (ratio, goal))
+        return [goal for _, goal in heapq.nlargest(n, best)]
+
 
 goals_list = get_all_goals()
 stripped_goals = [strip_text(goal) for goal in goals_list]
 stripped_goal_to_goal = {strip_text(goal): goal for goal in goals_list}
+goal_index = GoalIndex(stripped_goals)
 
 
 def add_correction(bad_text: str, good_text: str):
+    global journal_length
     corrections[bad_text] = good_text
-    with open("corrections.json", "w") as f:
+    line = (json.dumps([bad_text, good_text]) + "\n").encode()
+    with open(CORRECTIONS_JOURNAL, "ab") as f:
+        # drop a partial line left by a crash so this one starts on its own line
+        if f.tell() > journal_length:
+            f.truncate(journal_length)
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    journal_length += len(line)
+
+
+# Writes every correction to the snapshot and empties the journal. The new
+# snapshot is written next to the old one and swapped in with os.replace, so a
+# crash leaves either the old snapshot and the journal or the new snapshot, and
+# the journal only repeats what's already in it.
+def compact_corrections():
+    global journal_length
+    temp_name = CORRECTIONS_SNAPSHOT + ".tmp"
+    with open(temp_name, "w") as f:
         f.write(json.dumps(corrections, indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, CORRECTIONS_SNAPSHOT)
+    if os.path.isfile(CORRECTIONS_JOURNAL):
+        os.remove(CORRECTIONS_JOURNAL)
+    journal_length = 0
 
 
 def get_confirmed_text(text: str) -> str | None:
@@ -39,7 +175,10 @@ def get_confirmed_text(text: str) -> str | None:
 
 
 def get_best_matches(text: str, num_matches: int) -> list[str]:
-    best_matches = difflib.get_close_matches(
-        strip_text(text), stripped_goals, num_matches, 0.2
-    )
+    best_matches = goal_index.get_close_matches(strip_text(text), num_matches, 0.2)
     return [stripped_goal_to_goal[stripped] for stripped in best_matches]
+
+
+# suggestions for every text at once, looking up each distinct text only once
+def get_all_best_matches(texts: list[str], num_matches: int) -> dict[str, list[str]]:
+    return {text: get_best_matches(text, num_matches) for text in set(texts)}
@@ -1,7 +1,9 @@
 import cv2
+import functools
+import numpy
 
+import telemetry
 from color import Color
-from find_table import get_best_table_from_image
 from square import Square
 
 
@@ -25,7 +27,37 @@ def get_reference_colors() -> dict[Color, list[cv2.typing.Scalar]]:
     }
 
 
-reference_colors = get_reference_colors()
+class ReferencePalette:
+    def __init__(self, all_colors: dict[Color, list[cv2.typing.Scalar]]):
+        # one row per reference swatch, in the same order get_closest_color_name
+        # iterates so argmin breaks ties the same way
+        self.names = [name for name, bgrs in all_colors.items() for _ in bgrs]
+        self.bgrs = numpy.array(
+            [bgr[:3] for bgrs in all_colors.values() for bgr in bgrs],
+            dtype=numpy.float64,
+        )
+
+    def get_mask(self, color_restrictions: None | set[Color]) -> numpy.ndarray:
+        if color_restrictions is None:
+            return numpy.ones(len(self.names), dtype=bool)
+        return numpy.array([name in color_restrictions for name in self.names])
+
+    # raw_colors is (n, 3) bgr, returns the closest allowed color for each row
+    def classify(self, raw_colors: numpy.ndarray, mask: numpy.ndarray) -> list[Color]:
+        with telemetry.stage("classify"):
+            diff = raw_colors[:, numpy.newaxis, :] - self.bgrs[numpy.newaxis, :, :]
+            squared = diff * diff
+            # summed in the same order as get_closest_color_name so results are
+            # identical down to the last bit
+            dists = squared[:, :, 0] + squared[:, :, 1] + squared[:, :, 2]
+            dists[:, ~mask] = numpy.inf
+            return [self.names[i] for i in numpy.argmin(dists, axis=1)]
+
+
+# reads every swatch in colors/, so it waits until something classifies
+@functools.cache
+def get_reference_palette() -> ReferencePalette:
+    return ReferencePalette(get_reference_colors())
 
 
 def get_closest_color_name(
@@ -49,6 +81,8 @@ def get_closest_color_name(
 
 
 def find_table_from_video(cap: cv2.VideoCapture) -> list[Square] | None:
+    from find_table import get_best_table_from_frame
+
     fps = cap.get(cv2.CAP_PROP_FPS)
     ten_mins = fps * 60 * 10
     cur_frame = ten_mins
@@ -56,8 +90,7 @@ def find_table_from_video(cap: cv2.VideoCapture) -> list[Square] | None:
         cap.set(cv2.CAP_PROP_POS_FRAMES, cur_frame)
         ret, frame = cap.read()
         if ret:
-            cv2.imwrite("temp_frame.jpg", frame)
-            table = get_best_table_from_image("temp_frame.jpg")
+            table = get_best_table_from_frame(frame)
             if table is not None:
                 return table
             cur_frame += ten_mins
@@ -67,8 +100,8 @@ def find_table_from_video(cap: cv2.VideoCapture) -> list[Square] | None:
     return None
 
 
-# get a 1/4 size rectangle with the same center as Cell
-def get_center_rect(cell: Square, frame: cv2.typing.MatLike) -> cv2.typing.MatLike:
+# (x_min, x_max, y_min, y_max) of a 1/4 size rectangle with the same center as Cell
+def get_center_rect_bounds(cell: Square) -> tuple[int, int, int, int]:
     x_delta = (cell.x_max - cell.x_min) / 8
     y_delta = (cell.y_max - cell.y_min) / 8
 
@@ -77,6 +110,13 @@ def get_center_rect(cell: Square, frame: cv2.typing.MatLike) -> cv2.typing.MatLi
     y_min = round(cell.y_min + y_delta)
     y_max = round(cell.y_max - y_delta)
 
+    return (x_min, x_max, y_min, y_max)
+
+
+# get a 1/4 size rectangle with the same center as Cell
+def get_center_rect(cell: Square, frame: cv2.typing.MatLike) -> cv2.typing.MatLike:
+    x_min, x_max, y_min, y_max = get_center_rect_bounds(cell)
+
     return frame[
         y_min:y_max,
         x_min:x_max,
@@ -98,19 +138,106 @@ def get_raw_colors(
     ]
 
 
+# Same means as get_raw_colors, but the rectangles are rounded once per table
+# instead of once per frame and the result is an (n, 3) array that can go
+# straight into ReferencePalette.classify. Computing all the means from one
+# integral image of the table was measured to be slower than this on 1080p
+# frames, since the work is dominated by reading the pixels, not by the 25 calls.
+class CellMeanExtractor:
+    def __init__(self, table: list[Square]):
+        bounds = [get_center_rect_bounds(cell) for cell in table]
+        self.x_min = max(0, min(b[0] for b in bounds))
+        self.x_max = max(b[1] for b in bounds)
+        self.y_min = max(0, min(b[2] for b in bounds))
+        self.y_max = max(b[3] for b in bounds)
+        # relative to the table roi
+        self.slices = [
+            (
+                slice(y_min - self.y_min, y_max - self.y_min),
+                slice(x_min - self.x_min, x_max - self.x_min),
+            )
+            for x_min, x_max, y_min, y_max in bounds
+        ]
+
+    def get_roi(self, frame: cv2.typing.MatLike) -> cv2.typing.MatLike:
+        return frame[self.y_min : self.y_max, self.x_min : self.x_max]
+
+    # indices picks which cells to get the means of, defaulting to all of them
+    def get_means_from_roi(
+        self, roi: cv2.typing.MatLike, indices: list[int] | None = None
+    ) -> numpy.ndarray:
+        slices = self.slices if indices is None else [self.slices[i] for i in indices]
+        return numpy.array([cv2.mean(roi[s])[:3] for s in slices])
+
+    def get_means(
+        self, frame: cv2.typing.MatLike, indices: list[int] | None = None
+    ) -> numpy.ndarray:
+        with telemetry.stage("cell_means"):
+            return self.get_means_from_roi(self.get_roi(frame), indices)
+
+    # cell means over every THUMBNAIL_STEP-th pixel in each direction. About a
+    # third of the cost of get_means, and a cell changing color still moves its
+    # thumbnail mean by the full distance between the colors.
+    def get_thumbnail_means(self, frame: cv2.typing.MatLike) -> numpy.ndarray:
+        with telemetry.stage("thumbnail_means"):
+            roi = self.get_roi(frame)
+            return numpy.array(
+                [
+                    cv2.mean(roi[s][::THUMBNAIL_STEP, ::THUMBNAIL_STEP])[:3]
+                    for s in self.slices
+                ]
+            )
+
+
+THUMBNAIL_STEP = 8
+
+
+# Lets MatchWithVideo.get_colors reuse the last classification when no cell's
+# thumbnail mean has moved by threshold or more in any channel since the last
+# classified frame. The closest reference colors (brown and red) are 33 apart
+# in their most different channel, so the threshold should stay well under that.
+class FrameDiffGate:
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.thumbnail: numpy.ndarray | None = None
+        # result of the last classified frame
+        self.colors: list[Color] | None = None
+        self.checks = 0
+        self.hits = 0
+        self.check_secs = 0.0
+        self.classify_secs = 0.0
+
+    def is_unchanged(self, thumbnail: numpy.ndarray) -> bool:
+        self.checks += 1
+        if (
+            self.thumbnail is not None
+            and numpy.abs(thumbnail - self.thumbnail).max() < self.threshold
+        ):
+            self.hits += 1
+            return True
+        self.thumbnail = thumbnail
+        return False
+
+    def store(self, colors: list[Color] | None):
+        self.colors = colors
+
+    def get_stats(self) -> str:
+        classified = self.checks - self.hits
+        if classified == 0:
+            return f"Frame gate checked {self.checks} frames"
+        classify_secs = self.classify_secs / classified
+        saved_secs = self.hits * classify_secs - self.check_secs
+        return (
+            f"Frame gate skipped {self.hits} of {self.checks} frames, saving about "
+            f"{1000 * saved_secs:.1f} ms ({1000 * classify_secs:.3f} ms per "
+            f"classification, {1000 * self.check_secs:.1f} ms spent checking)"
+        )
+
+
 def get_named_colors(
     table: list[Square],
     frame: cv2.typing.MatLike,
-    color_restrictions: None | set[Color],
+    color_mask: numpy.ndarray,
 ) -> list[Color]:
-    raw_colors = get_raw_colors(table, frame)
-    valid_colors = (
-        reference_colors
-        if color_restrictions is None
-        else {
-            color: avgs
-            for color, avgs in reference_colors.items()
-            if color in color_restrictions
-        }
-    )
-    return [get_closest_color_name(valid_colors, rc) for rc in raw_colors]
+    raw_colors = numpy.array(get_raw_colors(table, frame))[:, :3]
+    return get_reference_palette().classify(raw_colors, color_mask)